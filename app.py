@@ -1,57 +1,143 @@
-import base64
 import os
-import plotly.express as px
-from plotly.tools import mpl_to_plotly
-from components.helpers import create_file, initialize
-
-import mne
-import numpy as np
+import uuid
+import zlib
+import diskcache
 import dash
-from dash import Input, Output, State, html, dcc
+from dash import DiskcacheManager, Input, Output, Patch, State, html, dcc
 import plotly.graph_objects as go
-from components.data_acc import calculate_psd, construct_mne_object, extract_all_power_bands, get_file, bands_names, bands_freq, pd2mne, plot_raw_channels, plot_power_band, power_band2csv, channels_names_21, channels_names_68
-from components.helpers import filter_data
-from components.layout import create_viz_data_layout
+from flask import jsonify, request
+from components.data_acc import bands_names, bands_freq, plot_raw_channels, plot_power_band, power_band_columns, plot_band_topomaps, get_x_range, plot_signal_range, get_band_index, compute_segment_powers, moving_band_power, plot_width_px
+from components.data_acc import compute_connectivity, connectivity_matrix, connectivity_measures, load_cached_connectivity, save_cached_connectivity
+from components.channels import channel_index, channel_indices, channels_names_21, channels_names_68
+from components.helpers import create_file, initialize, filter_channels, start_data_thread, is_valid_id, append_chunk, complete_upload, max_upload_bytes, upload_path
+from components.layout import create_metrics_panel, create_viz_data_layout
+from components.store import RecordingStore
+from components.metrics import debug_panel_enabled, metrics, metrics_table, register_metrics
+from components.live import get_stream, live_window, read_new_samples, start_replay, stop_replay
+from components.pipeline import process_upload, upload_stages
+from components.export import export_formats, export_response
+from components.quality import bad_intervals
+from components.cohort import cohort_columns, load_cohort, plot_cohort_topomaps, process_cohort
 
 # temporary workaround for deployment test
-if not os.path.exists("data") or not os.path.exists("temp_files.json"):
-        initialize()
-
-from PIL import Image
-import dash
-from dash import Input, Output, State, html, dcc
-import plotly.graph_objects as go
-from components.data_acc import calculate_psd, construct_mne_object, extract_all_power_bands, get_file, bands_names, bands_freq, pd2mne, plot_raw_channels, plot_power_band, power_band2csv, create_top_map
-from components.helpers import filter_data, cleanup_expired_files, start_data_thread
-from components.layout import create_viz_data_layout
-import threading
+initialize()
 
 app = dash.Dash(__name__)
 app.title = "BrainUp"  
 app._favicon = "logo.png"
 server = app.server
+register_metrics(app)
 
 
-# Define global constants (in my opinion temporary solution)
-mne_raw = construct_mne_object()
-power_bands = []
-
+# Define global constants
 number_of_channels = 0
 channels_names = channels_names_21 # Default channel names for 21 electrodes
-assigned_channels_names = []  
 
-spectrum = None
+# uploaded recordings are resolved by session id, never kept in module globals
+recording_store = RecordingStore()
+# heavy upload processing runs outside of web workers
+background_callback_manager = DiskcacheManager(diskcache.Cache(os.path.join("data", "jobs")))
+
 
+def serve_layout():
+    # every page load gets its own session id
+    return html.Div([
+        create_viz_data_layout(bands_names, number_of_channels),
+        dcc.Store(id="channels-names-store", data=channels_names),  
+        dcc.Store(id="session-id", data=uuid.uuid4().hex),
+    ] + ([create_metrics_panel()] if debug_panel_enabled else []))
 
-app.layout = html.Div([
-    create_viz_data_layout(mne_raw, bands_names, number_of_channels),
-    dcc.Store(id="channels-names-store", data=channels_names),  
-])
+app.layout = serve_layout
 
-# manages saved data
+# manages saved data, with gunicorn --preload every worker starts it after fork (gunicorn.conf.py)
 start_data_thread()
 
-# Callback for uploading file and nuking the whole page
+# Resumable chunked upload, used by assets/chunked_upload.js instead of base64 contents
+@server.route("/upload/<upload_id>", methods=["GET", "POST"])
+def upload_chunk(upload_id):
+    if not is_valid_id(upload_id):
+        return jsonify(error="Invalid upload id"), 400
+    offset = request.args.get("offset", default=-1, type=int)
+    if request.method == "GET": # client asks where to resume
+        offset = -1
+    if request.content_length is not None and offset + request.content_length > max_upload_bytes:
+        return jsonify(error="Upload too large"), 413
+    try:
+        size, accepted = append_chunk(upload_id, offset, request.stream)
+    except ValueError:
+        return jsonify(error="Upload too large"), 413
+    return jsonify(size=size), 200 if accepted or request.method == "GET" else 409
+
+@server.route("/upload/<upload_id>/complete", methods=["POST"])
+def upload_complete(upload_id):
+    filename = (request.get_json(silent=True) or {}).get("filename", "")
+    if not is_valid_id(upload_id) or not filename:
+        return jsonify(error="Invalid upload"), 400
+    try:
+        complete_upload(upload_id, filename)
+    except ValueError as e: # file types the app can't read
+        return jsonify(error=str(e)), 400
+    except FileNotFoundError:
+        return jsonify(error="Unknown upload"), 404
+    return jsonify(upload_id=upload_id, filename=filename)
+
+# Long-format band power export, CSV is streamed in chunks instead of built in a callback
+@server.route("/download/<kind>/<session_id>.<fmt>")
+def download_export(kind, session_id, fmt):
+    if not is_valid_id(session_id) or fmt not in export_formats:
+        return jsonify(error="Invalid export"), 400
+    if kind == "power_bands":
+        session = recording_store.get(session_id)
+        if session is None or session["band_powers"] is None:
+            return jsonify(error="Power spectrum isn't computed"), 404
+        columns = power_band_columns(session["band_powers"], session["raw"].info["ch_names"])
+    elif kind == "cohort":
+        subjects = load_cohort(session_id)
+        if subjects is None:
+            return jsonify(error="No cohort uploaded"), 404
+        columns = cohort_columns(subjects)
+    else:
+        return jsonify(error="Unknown export"), 404
+    return export_response(columns, kind, fmt)
+
+# Background callback for processing uploaded file stage by stage
+@app.callback(
+    Output("upload-stage", "data"),
+    Input("upload-file-zone", "contents"),
+    Input("upload-file-zone", "filename"),
+    Input("uploaded-file", "data"),
+    State("session-id", "data"),
+    background=True,
+    manager=background_callback_manager,
+    progress=[
+        Output("upload-progress", "value"),
+        Output("upload-progress", "max"),
+        Output("upload-progress-label", "children"),
+        Output("upload-partial", "data"),
+    ],
+    running=[(Output("upload-progress-container", "style"), {"display": "block"}, {"display": "none"})],
+    prevent_initial_call=True
+)
+def upload_file(set_progress, file, filename, uploaded_file, session_id):
+    # file streamed in chunks to /upload is already on disk
+    if dash.callback_context.triggered_id == "uploaded-file" and uploaded_file:
+        filename = uploaded_file["filename"]
+        file_path = upload_path(uploaded_file["upload_id"], filename)
+    # quit if nothing is uploaded
+    elif filename is None:
+        print("No file uploaded")
+        return dash.no_update
+    else:
+        file_path = create_file(file, os.path.splitext(filename)[1].lstrip("."))
+    print(f"File uploaded: {filename}")
+
+    def report(stage_index, label, result):
+        set_progress((str(stage_index), str(len(upload_stages)), label, result))
+
+    # upload id is the content hash, parsed data is memory-mapped from cache
+    return process_upload(session_id, file_path, filename, report)
+
+# Callback for nuking the whole page as soon as the uploaded file is parsed
 @app.callback(
     Output("name-channels", "data"),
     Output("number-of-channels", "data"),
@@ -62,39 +148,30 @@ start_data_thread()
     Output("main-container", "style", allow_duplicate=True),
     Output("channel-assignment-container", "style", allow_duplicate=True),
     Output("assign-channels-confirm-button", "style", allow_duplicate=True),
-    Input("upload-file-zone", "contents"),
-    Input("upload-file-zone", "filename"),
-    State("channels-names-store", "data"), 
+    Output("active-upload", "data"),
+    Input("upload-partial", "data"),
+    Input("upload-stage", "data"),
+    State("active-upload", "data"),
     prevent_initial_call=True
 )
-def upload_file(file, filename, channels_names):
-    global mne_raw, spectrum, power_bands
-    
+def show_uploaded_file(partial_result, result, active_upload):
+    result = result if dash.callback_context.triggered_id == "upload-stage" else partial_result
+    # reset only once per upload, later stages just refresh plots
+    if not result or result["upload_id"] == active_upload:
+        return (dash.no_update,) * 10
     channels_names = channels_names_21
-    
-    # quit if nothing is uploaded
-    if filename is None:
-        print("No file uploaded")
-        return dash.no_update
-    
-    raw_data = get_file(file, filename)
-    print(f"File uploaded: {filename}")
-    
-    mne_raw = pd2mne(raw_data)
-    spectrum, channels_info = calculate_psd(raw_data)
-    power_bands = extract_all_power_bands(spectrum)
-    number_of_channels = len(channels_info)
     # Return reset values for all components
     return (
         channels_names,
-        number_of_channels,
+        result["n_channels"],
         "raw",
         None,
         None,
         None,
         {"display": "None"},
         {"display": "None"},  
-        {"display": "None"}  
+        {"display": "None"},
+        result["upload_id"],
     )
 
 # Callback for updating the layout to show channel name asigment container when file is uploaded
@@ -153,10 +230,7 @@ def update_electrode_view(prev_clicks, next_clicks, current_view, channels_names
     Input("channels-names-store", "data"),  # Add this input
     prevent_initial_call=True,
 )
-def update_channel_assigment_children(callback_number_of_channels, current_channels_names):
-    global number_of_channels, channels_names
-    number_of_channels = callback_number_of_channels
-    channels_names = current_channels_names  
+def update_channel_assigment_children(number_of_channels, channels_names):
     print(f"Updating channel assignment for {number_of_channels} channels. Names: {'21' if channels_names == channels_names_21 else '68'}")
     from components.layout import create_channel_assignment_row
     return [
@@ -201,15 +275,20 @@ def toggle_channel_multi_select(vis_type):
     Output("channel-dropdown", "value"),
     [Input("select-all-channels", "n_clicks"),
      Input("clear-channels", "n_clicks")],
+    State("session-id", "data"),
     prevent_initial_call=True
 )
-def handle_channel_buttons(select_all_clicks, clear_clicks):
+def handle_channel_buttons(select_all_clicks, clear_clicks, session_id):
     ctx = dash.callback_context
     if not ctx.triggered:
         return dash.no_update
 
     triggered_id = ctx.triggered[0]["prop_id"].split(".")[0]
     if triggered_id == "select-all-channels":
+        session = recording_store.get(session_id)
+        if session is None:
+            return dash.no_update
+        mne_raw = session["raw"]
         print("mne_raw.info[\"ch_names\"]:", mne_raw.info["ch_names"])
         return [ch for ch in mne_raw.info["ch_names"]]  
     elif triggered_id == "clear-channels":
@@ -222,7 +301,7 @@ def handle_channel_buttons(select_all_clicks, clear_clicks):
     Input("vis-type", "value")
 )
 def toggle_filter_selection_container(vis_type):
-    if vis_type == "specific_band":
+    if vis_type in ("specific_band", "band_time", "connectivity"):
         return {"display": "none"}  
     return {"display": "block"}  
 
@@ -234,7 +313,7 @@ def toggle_filter_selection_container(vis_type):
      prevent_initial_call=True
 )
 def toggle_custom_frequency_slider(filter_frequency, vis_type):
-    if vis_type == "specific_band":
+    if vis_type in ("specific_band", "band_time", "connectivity"):
         return {"display": "none"}  
     elif filter_frequency == "custom":
         return {"display": "block"}  
@@ -247,117 +326,328 @@ def toggle_custom_frequency_slider(filter_frequency, vis_type):
     prevent_initial_call=True
 )
 def toggle_band_dropdown_visibility(vis_type):
-    if vis_type == "specific_band":
+    if vis_type in ("specific_band", "topo", "band_time", "connectivity"):
         return {"display": "block"} 
     else:
         return {"display": "none"} 
 
+# Callback for showing/hiding the window length slider of band power over time
+@app.callback(
+    Output("window-length-container", "style"),
+    Input("vis-type", "value"),
+    prevent_initial_call=True
+)
+def toggle_window_length_slider(vis_type):
+    if vis_type == "band_time":
+        return {"display": "block"}
+    return {"display": "none"}
+
+# Callback for showing/hiding the connectivity measure selection
+@app.callback(
+    Output("connectivity-measure-container", "style"),
+    Input("vis-type", "value"),
+    prevent_initial_call=True
+)
+def toggle_connectivity_measure(vis_type):
+    if vis_type == "connectivity":
+        return {"display": "block"}
+    return {"display": "none"}
+
+def patch_traces(shown, channels, make_traces, refresh=False):
+    """
+    Patch turning figure with one trace per channel in shown into one showing channels
+    Traces of deselected channels are deleted and new channels are appended,
+    with refresh the kept traces get new x/y data too (zoomed range)
+    Returns the patch and channels in trace order
+    """
+    patched = Patch()
+    kept = [ch for ch in shown if ch in channels]
+    added = [ch for ch in channels if ch not in shown]
+    for i in reversed(range(len(shown))):
+        if shown[i] not in channels:
+            del patched["data"][i]
+    if refresh:
+        for i, trace in enumerate(make_traces(kept)):
+            patched["data"][i]["x"] = trace["x"]
+            patched["data"][i]["y"] = trace["y"]
+    for trace in make_traces(added):
+        patched["data"].append(trace)
+    return patched, kept + added
+
 # Callback for updating the plot
 @app.callback(
     Output("eeg-plot", "figure"),
     Output("eeg-plot", "style"),
-    Output("topo-img", "src"),
-    Output("topo-img", "style"),
+    Output("plot-state", "data"),
     [Input("vis-type", "value"),
      Input("channel-dropdown", "value"),
      Input("band-dropdown", "value"),
      Input("filter-frequency", "value"),
-     Input("custom-frequency-slider", "value")],
+     Input("custom-frequency-slider", "value"),
+     Input("eeg-plot", "relayoutData"),
+     Input("upload-stage", "data"),
+     Input("window-length-slider", "value"),
+     Input("connectivity-measure", "value")],
+     State("plot-state", "data"),
+     State("session-id", "data"),
      prevent_initial_call=True
 )
-def update_plot(vis_type, selected_channels, selected_band, filter_frequency, custom_range):
+def update_plot(vis_type, selected_channels, selected_band, filter_frequency, custom_range, relayout_data, upload_stage, window_length, measure, plot_state, session_id):
     """
-    Update plot or display image
-    If vis_type == "topo", then eeg-plot element isn't updated and vice versa 
+    Update plot of raw signal, band PSD, topographic maps, band power over time or channel connectivity
+    plot-state holds what the figure in the browser shows, if only the channel selection or
+    the zoomed range changed the figure is patched (traces added, removed or re-decimated)
+    instead of sending it whole
+    Changing the window length re-aggregates cached segment band powers
+    Plot is refreshed when the background upload processing finishes
     """
+    ctx = dash.callback_context
+    triggered_ids = [t["prop_id"] for t in ctx.triggered]
+    x_range = get_x_range(relayout_data)
+    # zoom/pan only matters for the raw signal
+    if triggered_ids == ["eeg-plot.relayoutData"] and (vis_type != "raw" or not any(key.startswith("xaxis.") for key in relayout_data)):
+        return dash.no_update, dash.no_update, dash.no_update
 
     fig = go.Figure()
-    img = go.Image()
     # Prevent error if selected_channels is empty or None
     if not selected_channels:
         print("Selected channels are empty or None.")
-        return fig, {"display": "none"}, dash.no_update, dash.no_update  
+        return fig, {"display": "none"}, None
+
+    session = recording_store.get(session_id)
+    if session is None:
+        return fig, {"display": "none"}, None
+    mne_raw = session["raw"]
       
-    # Ensure selected_channels are present in mne_raw.info["ch_names"]
-    valid_channels = [ch for ch in selected_channels if ch in mne_raw.info["ch_names"]]
+    # Ensure selected_channels are present in mne_raw.info["ch_names"] (also by alias, e.g. T7 for T3)
+    valid_channels = [ch for ch in selected_channels if channel_index(mne_raw.info["ch_names"], ch) is not None]
     if not valid_channels:
-        return fig, {"display": "none"}, dash.no_update, dash.no_update  
+        return fig, {"display": "none"}, None
 
+    # PSD is still computed in the background, raw signal is already available
+    if vis_type in ("specific_band", "topo", "connectivity") and session["spectrum"] is None:
+        fig.update_layout(title="Power spectrum is still being computed...")
+        return fig, {"display": "block"}, None
 
-    # Apply frequency filtering
-    filtered_raw = mne_raw.copy()  
+    # Choose frequency filtering band
+    low_freq, high_freq = None, None
     if filter_frequency == "low":
-        filtered_raw = filter_data(filtered_raw, high_freq=1)
+        high_freq = 1
     elif filter_frequency == "high":
-        filtered_raw = filter_data(filtered_raw, low_freq=25)
+        low_freq = 25
     elif filter_frequency == "custom":
         if custom_range is not None:
-            filtered_raw = filter_data(filtered_raw, low_freq=custom_range[0], high_freq=custom_range[1])
-        else:
-            # Use default values or skip filtering
-            filtered_raw = filter_data(filtered_raw)
+            low_freq, high_freq = custom_range
+        # Use default values or skip filtering
+
+    # everything except channels and zoom, the figure can be patched while it stays the same
+    view = {
+        "vis_type": vis_type,
+        "upload_id": session["upload_id"],
+        "stage": session["stage"],
+        "ch_names": zlib.crc32("\n".join(mne_raw.info["ch_names"]).encode()),
+        "band": selected_band,
+        "filter": [low_freq, high_freq] if vis_type == "raw" else None,
+        "window_length": window_length if vis_type == "band_time" else None,
+        "measure": measure if vis_type == "connectivity" else None,
+    }
+    incremental = plot_state is not None and plot_state["view"] == view
 
     # PSD visualization for specific band
     if vis_type == "specific_band":
         if selected_band is None:
-            return dash.no_update
-        band_data = plot_power_band(power_bands, selected_band, mne_raw, "all")
-        for ch_name, freqs, power in band_data:
-            if ch_name in valid_channels:
-                fig.add_trace(go.Scatter(x=freqs, y=power, mode="lines", name=ch_name))
-        for i, name in enumerate(bands_names):
-            if selected_band.lower() == name.lower():
-                band_index = i
-                break    
+            return dash.no_update, dash.no_update, dash.no_update
+        def make_traces(channels):
+            band_data = [plot_power_band(session["power_bands"], selected_band, mne_raw, ch)[0] for ch in channels]
+            return [go.Scatter(x=freqs, y=power, mode="lines", name=ch).to_plotly_json() for ch, freqs, power in band_data]
+        if incremental:
+            patched, shown = patch_traces(plot_state["channels"], valid_channels, make_traces)
+            return patched, dash.no_update, dict(plot_state, channels=shown)
+        fig.add_traces(make_traces(valid_channels))
+        band_index = get_band_index(selected_band)
         fig.update_layout(
             title=f"PSD for {selected_band} Band ({bands_freq[band_index][0]} - {bands_freq[band_index][1]} Hz) - Selected Channels", 
             xaxis_title="Frequency (Hz)", 
             yaxis_title="Power Spectral Density",
             yaxis=dict(autorange=True)  
         )
-        
+    
     # Raw signal visualization for selected channels  
     elif vis_type == "raw":
-        times, data = plot_raw_channels(filtered_raw, valid_channels)
-        for i, channel_name in enumerate(valid_channels):
-            fig.add_trace(go.Scatter(x=times, y=data[i], mode="lines", name=channel_name))
+        bad_indices = set(channel_indices(mne_raw.info["ch_names"], mne_raw.info["bads"]))
+
+        def make_traces(channels):
+            if not channels:
+                return []
+            if low_freq is None and high_freq is None:
+                times, data = plot_raw_channels(mne_raw, channels, x_range, pyramid=session["pyramid"])
+            else:
+                # only shown channels are filtered, results are cached per upload and band
+                filtered = filter_channels(mne_raw, channel_indices(mne_raw.info["ch_names"], channels), session["upload_id"], low_freq, high_freq)
+                times, data = plot_signal_range(filtered, mne_raw.info["sfreq"], x_range)
+            # bad channels found by the quality stage are drawn dotted
+            bads = [channel_index(mne_raw.info["ch_names"], ch) in bad_indices for ch in channels]
+            return [go.Scatter(
+                x=times[i], y=data[i], mode="lines", name=f"{ch} (bad)" if bads[i] else ch,
+                line=dict(dash="dot", color="gray") if bads[i] else None,
+            ).to_plotly_json() for i, ch in enumerate(channels)]
+        if incremental:
+            # the browser already shows the zoomed axis range, only the traces are re-decimated
+            patched, shown = patch_traces(plot_state["channels"], valid_channels, make_traces, refresh=x_range != plot_state["x_range"])
+            return patched, dash.no_update, dict(plot_state, channels=shown, x_range=x_range)
+        fig.add_traces(make_traces(valid_channels))
         fig.update_layout(
             title="Raw Signal - Selected Channels", 
             xaxis_title="Time (s)", 
             yaxis_title="Amplitude (uV)",
-            xaxis=dict(autorange=True),  
-            yaxis=dict(range=[-100, 100]) 
+            xaxis=dict(autorange=True) if x_range is None else dict(range=x_range),  
+            yaxis=dict(range=[-100, 100]),
+            uirevision="raw" # keep zoom state between re-decimations
         )
-
-    # Display topographic map
+        # bad windows found by the quality stage are shaded
+        if session["quality"] is not None:
+            fig.update_layout(shapes=[
+                dict(type="rect", xref="x", yref="paper", x0=start, x1=stop, y0=0, y1=1, fillcolor="red", opacity=0.15, line_width=0, layer="below")
+                for start, stop in bad_intervals(session["quality"])
+            ])
+            if mne_raw.info["bads"]:
+                fig.update_layout(title=f"Raw Signal - Selected Channels (bad channels: {', '.join(mne_raw.info['bads'])})")
+
+    # Display topographic maps of the selected band, all bands if none is selected
     elif vis_type == "topo":
-        mat_fig = create_top_map(spectrum)       
-        img_path = create_file(mat_fig, ".png")
-        image = Image.open(img_path)
-        return dash.no_update, {"display": "none"}, image, {"display": "block"}
-    return fig, {"display": "block"}, dash.no_update, {"display": "none"} 
+        # maps show all channels, selection doesn't change them
+        if incremental:
+            return dash.no_update, dash.no_update, dash.no_update
+        fig = plot_band_topomaps(session["spectrum"], session["band_powers"], selected_band)
+
+    # Band power in a window sliding over the recording, segment spectra are computed once per upload
+    elif vis_type == "band_time":
+        if selected_band is None:
+            return dash.no_update, dash.no_update, dash.no_update
+        if session["segment_powers"] is None:
+            session["segment_powers"] = compute_segment_powers(session["recording"], mne_raw.info["sfreq"])
+        band_index = get_band_index(selected_band)
+        times, power = moving_band_power(session["segment_powers"], band_index, window_length or 10)
+
+        def make_traces(channels):
+            return [go.Scatter(x=times, y=power[channel_index(mne_raw.info["ch_names"], ch)], mode="lines", name=ch).to_plotly_json() for ch in channels]
+        if incremental:
+            patched, shown = patch_traces(plot_state["channels"], valid_channels, make_traces)
+            return patched, dash.no_update, dict(plot_state, channels=shown)
+        fig.add_traces(make_traces(valid_channels))
+        fig.update_layout(
+            title=f"{selected_band} Band Power over Time ({bands_freq[band_index][0]} - {bands_freq[band_index][1]} Hz, {window_length or 10} s window) - Selected Channels",
+            xaxis_title="Time (s)",
+            yaxis_title="Band Power",
+            yaxis=dict(autorange=True)
+        )
+
+    # Coherence or PLV between selected channels, all pairs are computed once per upload from one batched FFT
+    elif vis_type == "connectivity":
+        if selected_band is None:
+            return dash.no_update, dash.no_update, dash.no_update
+        if session["connectivity"] is None:
+            connectivity = load_cached_connectivity(session["upload_id"])
+            if connectivity is None:
+                connectivity = compute_connectivity(session["recording"], mne_raw.info["sfreq"], quality=session["quality"])
+                save_cached_connectivity(session["upload_id"], connectivity)
+            session["connectivity"] = connectivity
+        # bad channels are left out like in topomaps
+        bad_indices = set(channel_indices(mne_raw.info["ch_names"], mne_raw.info["bads"]))
+        indices = channel_indices(mne_raw.info["ch_names"], valid_channels)
+        kept = [k for k, i in enumerate(indices) if i not in bad_indices] or list(range(len(indices)))
+        channels, indices = [valid_channels[k] for k in kept], [indices[k] for k in kept]
+        matrix = connectivity_matrix(session["connectivity"], measure, selected_band, indices)
+        band_index = get_band_index(selected_band)
+        fig.add_trace(go.Heatmap(z=matrix, x=channels, y=channels, zmin=0, zmax=1, colorscale="Viridis", colorbar=dict(title=connectivity_measures[measure])))
+        fig.update_layout(
+            title=f"{connectivity_measures[measure]} - {selected_band} Band ({bands_freq[band_index][0]} - {bands_freq[band_index][1]} Hz)",
+            yaxis=dict(autorange="reversed", scaleanchor="x"),
+        )
+    return fig, {"display": "block"}, {"view": view, "channels": valid_channels, "x_range": x_range}
 
 # Callback for updating the band dropdown options based on the selected visualization type
 @app.callback(
     Output("band-dropdown", "value", allow_duplicate=True),
-    [Input("vis-type", "value"), Input("upload-file-zone", "contents")],
+    [Input("vis-type", "value"), Input("upload-file-zone", "contents"), Input("uploaded-file", "data")],
     prevent_initial_call=True
 )
-def reset_band_dropdown(vis_type, file_contents):
-    if vis_type == "specific_band" or file_contents is not None:
+def reset_band_dropdown(vis_type, file_contents, uploaded_file):
+    if vis_type == "specific_band" or file_contents is not None or uploaded_file is not None:
         return 'Delta'
     return dash.no_update
 
-# Callback for downloading the power band data as CSV
+# Callback for pointing the export links to the selected format
 @app.callback(
-    Output("download-dataframe-csv", "data"),
-    Input("download-button", "n_clicks"),
-    State("name-channels", "data"),
+    Output("download-link", "href"),
+    Output("cohort-export-link", "href"),
+    Input("download-format", "value"),
+    Input("cohort-export-format", "value"),
+    Input("session-id", "data"),
+)
+def update_export_links(power_band_format, cohort_format, session_id):
+    return f"/download/power_bands/{session_id}.{power_band_format}", f"/download/cohort/{session_id}.{cohort_format}"
+
+# Background callback for processing all files of a cohort on a process pool
+@app.callback(
+    Output("cohort-result", "data"),
+    Input("cohort-upload-zone", "contents"),
+    Input("cohort-upload-zone", "filename"),
+    Input("cohort-files", "data"),
+    State("session-id", "data"),
+    background=True,
+    manager=background_callback_manager,
+    progress=[
+        Output("cohort-progress", "value"),
+        Output("cohort-progress", "max"),
+        Output("cohort-progress-label", "children"),
+    ],
+    running=[(Output("cohort-progress-container", "style"), {"display": "block"}, {"display": "none"})],
+    prevent_initial_call=True
+)
+def upload_cohort(set_progress, contents, filenames, cohort_files, session_id):
+    # files streamed in chunks to /upload are already on disk
+    if dash.callback_context.triggered_id == "cohort-files" and cohort_files:
+        files = [(upload_path(f["upload_id"], f["filename"]), f["filename"]) for f in cohort_files]
+    elif not filenames:
+        return dash.no_update
+    else:
+        files = [(create_file(c, os.path.splitext(name)[1].lstrip(".")), name) for c, name in zip(contents, filenames)]
+    print(f"Cohort uploaded: {len(files)} files")
+
+    def report(done, total):
+        set_progress((str(done), str(total), f"Processed {done} of {total} files"))
+
+    report(0, len(files))
+    return process_cohort(session_id, files, report)
+
+# Callback for cohort mean/SD topomaps
+@app.callback(
+    Output("cohort-plot", "figure"),
+    Input("cohort-result", "data"),
+    Input("cohort-statistic", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True,
+)
+def update_cohort_plot(cohort_result, statistic, session_id):
+    subjects = load_cohort(session_id)
+    if subjects is None:
+        return dash.no_update
+    return plot_cohort_topomaps(subjects, statistic)
+
+# Callback for listing cohort files that couldn't be processed
+@app.callback(
+    Output("cohort-failed", "children"),
+    Input("cohort-result", "data"),
     prevent_initial_call=True,
 )
-def download_power_band(n_clicks, name_channels):
-    df = power_band2csv(power_bands, name_channels)
-    return dcc.send_data_frame(df.to_csv, "power_bands.csv")
+def show_cohort_failed(cohort_result):
+    if not cohort_result or not cohort_result.get("failed"):
+        return None
+    return [
+        html.P(f"Skipped {len(cohort_result['failed'])} file(s) that couldn't be processed:"),
+        html.Ul([html.Li(f"{file_name}: {error}") for file_name, error in cohort_result["failed"]]),
+    ]
 
 # Callback for updating the layout to show/hide manually assigned channels
 @app.callback(
@@ -418,10 +708,10 @@ def channel_assigment_auto_rows_visibility(n_clicks, number_of_channels, channel
     Output("main-container", "style"),
     Input("assign-channels-confirm-button", "n_clicks"),
     State("channel-assignment-container", "children"),
+    State("session-id", "data"),
     prevent_initial_call=True
 )
-def confirm_channel_assignments(n_clicks, channel_assignment_rows):
-    global assigned_channels_names, mne_raw
+def confirm_channel_assignments(n_clicks, channel_assignment_rows, session_id):
     assigned_channels_names = []
     if n_clicks is None or n_clicks == 0:
         return dash.no_update, dash.no_update, dash.no_update
@@ -434,16 +724,90 @@ def confirm_channel_assignments(n_clicks, channel_assignment_rows):
             channel_name = f"Channel {i + 1}"
         new_channel_names.append(channel_name)
 
-    # Append new assignments to the global list
+    # Append new assignments to the list
     assigned_channels_names += new_channel_names
 
     print(f"Confirmed channel assignments: {assigned_channels_names}")
     
-    mapping = dict(zip(mne_raw.info['ch_names'], assigned_channels_names))
-    mne_raw.rename_channels(mapping)
-    print(f"Renamed channels in mne_raw: {mne_raw.info['ch_names']}")
+    session = recording_store.get(session_id)
+    if session is None:
+        return dash.no_update, dash.no_update, dash.no_update
+    mapping = dict(zip(session["raw"].info['ch_names'], assigned_channels_names))
+    recording_store.rename_channels(session_id, mapping)
+    print(f"Renamed channels in mne_raw: {session['raw'].info['ch_names']}")
     
     return assigned_channels_names, {"display": "none"}, {"display": "block"}
 
+# Callback for starting/stopping live replay of the uploaded recording
+@app.callback(
+    Output("live-interval", "disabled"),
+    Output("live-cursor", "data"),
+    Output("live-plot", "figure"),
+    Input("live-start-button", "n_clicks"),
+    Input("live-stop-button", "n_clicks"),
+    State("channel-dropdown", "value"),
+    State("session-id", "data"),
+    prevent_initial_call=True
+)
+def toggle_live_replay(start_clicks, stop_clicks, selected_channels, session_id):
+    if dash.callback_context.triggered_id == "live-stop-button":
+        stop_replay(session_id)
+        return True, dash.no_update, dash.no_update
+    session = recording_store.get(session_id)
+    if session is None:
+        return dash.no_update, dash.no_update, dash.no_update
+    ch_names = session["raw"].info["ch_names"]
+    # selected channels are shown, all of them if none is selected
+    channels = [ch for ch in (selected_channels or []) if channel_index(ch_names, ch) is not None] or ch_names
+    start_replay(session_id, session["recording"], session["raw"].info["sfreq"], ch_names)
+    fig = go.Figure([go.Scatter(x=[], y=[], mode="lines", name=ch) for ch in channels])
+    fig.update_layout(title="Live Signal", xaxis_title="Time (s)", yaxis_title="Amplitude (uV)", uirevision="live")
+    return False, {"count": 0, "channels": channel_indices(ch_names, channels)}, fig
+
+# Callback for appending newly arrived samples to the live plot
+@app.callback(
+    Output("live-plot", "extendData"),
+    Output("live-band-plot", "figure"),
+    Output("live-cursor", "data", allow_duplicate=True),
+    Input("live-interval", "n_intervals"),
+    State("live-cursor", "data"),
+    State("session-id", "data"),
+    prevent_initial_call=True
+)
+def stream_live(n_intervals, cursor, session_id):
+    # the replay may run in another worker, its buffer is shared through a memory-mapped file
+    stream = get_stream(session_id)
+    if stream is None or cursor is None:
+        return dash.no_update, dash.no_update, dash.no_update
+    stream.touch() # replay stops once nobody polls it
+    channels = cursor["channels"]
+    times, data, count = read_new_samples(stream, channels, cursor["count"])
+    if count == cursor["count"]:
+        return dash.no_update, dash.no_update, dash.no_update
+    # only new samples are sent, the plot drops points older than the ring buffer
+    max_points = 2 * plot_width_px
+    extend = (dict(x=list(times), y=list(data)), list(range(len(channels))), max_points)
+
+    fig = go.Figure()
+    power = stream.band_power()
+    if power is not None:
+        for index in channels:
+            fig.add_trace(go.Bar(x=bands_names, y=power[index], name=stream.ch_names[index]))
+    fig.update_layout(title=f"Live Band Power (last {live_window} s)", yaxis_title="Band Power", barmode="group", uirevision="live")
+    return extend, fig, dict(cursor, count=count)
+
+# Callback for refreshing the metrics debug panel
+if debug_panel_enabled:
+    @app.callback(
+        Output("metrics-table", "children"),
+        Input("metrics-interval", "n_intervals"),
+    )
+    def update_metrics_panel(n_intervals):
+        rows = metrics_table(metrics.collect())
+        header = ["kind", "name", "count", "mean_ms", "cpu_ms", "kb", "peak_mb"]
+        return [html.Tr([html.Th(column) for column in header])] + [
+            html.Tr([html.Td(row[column]) for column in header]) for row in rows
+        ]
+
 if __name__ == "__main__":
     app.run(debug=True)
@@ -0,0 +1,97 @@
+// Streams files from the upload zones to the server in chunks (POST /upload/<id>)
+// instead of sending them base64 encoded through the dcc.Upload contents property
+(function () {
+    const CHUNK_SIZE = 8 * 1024 * 1024;
+    const MAX_RETRIES = 3;
+    // upload zone -> store receiving the finished upload(s), cohort zone takes all dropped files
+    const ZONES = {
+        "upload-file-zone": { store: "uploaded-file", multiple: false },
+        "cohort-upload-zone": { store: "cohort-files", multiple: true },
+    };
+
+    function newUploadId() {
+        const bytes = new Uint8Array(16);
+        window.crypto.getRandomValues(bytes);
+        return Array.from(bytes, (b) => b.toString(16).padStart(2, "0")).join("");
+    }
+
+    async function receivedSize(uploadId) {
+        const response = await fetch(`/upload/${uploadId}`);
+        return (await response.json()).size;
+    }
+
+    async function sendChunk(uploadId, file, offset) {
+        for (let attempt = 0; ; attempt++) {
+            try {
+                const chunk = file.slice(offset, offset + CHUNK_SIZE);
+                const response = await fetch(`/upload/${uploadId}?offset=${offset}`, { method: "POST", body: chunk });
+                // 409 means the server has a different size, resume from there
+                if (response.ok || response.status === 409) {
+                    return (await response.json()).size;
+                }
+                throw new Error(`Upload failed with status ${response.status}`);
+            } catch (error) {
+                if (attempt >= MAX_RETRIES) {
+                    throw error;
+                }
+                offset = await receivedSize(uploadId);
+            }
+        }
+    }
+
+    async function uploadFile(file) {
+        const uploadId = newUploadId();
+        let offset = 0;
+        while (offset < file.size) {
+            offset = await sendChunk(uploadId, file, offset);
+        }
+        const response = await fetch(`/upload/${uploadId}/complete`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ filename: file.name }),
+        });
+        if (!response.ok) {
+            throw new Error(`Completing upload failed with status ${response.status}`);
+        }
+        return await response.json();
+    }
+
+    async function uploadFiles(zone, files) {
+        // files are sent one after another, the server processes them together once all are on disk
+        const results = [];
+        for (const file of (zone.multiple ? Array.from(files) : [files[0]])) {
+            results.push(await uploadFile(file));
+        }
+        window.dash_clientside.set_props(zone.store, { data: zone.multiple ? results : results[0] });
+    }
+
+    function uploadZone(event) {
+        // fall back to dcc.Upload when set_props isn't available
+        if (!window.dash_clientside || !window.dash_clientside.set_props || !(event.target instanceof Element)) {
+            return null;
+        }
+        const element = event.target.closest(Object.keys(ZONES).map((id) => `#${id}`).join(","));
+        return element === null ? null : ZONES[element.id];
+    }
+
+    // capture phase runs before dcc.Upload reads the file
+    document.addEventListener("drop", (event) => {
+        const zone = uploadZone(event);
+        if (zone === null || !event.dataTransfer || !event.dataTransfer.files.length) {
+            return;
+        }
+        event.preventDefault();
+        event.stopPropagation();
+        uploadFiles(zone, event.dataTransfer.files).catch(console.error);
+    }, true);
+
+    document.addEventListener("change", (event) => {
+        const zone = uploadZone(event);
+        if (zone === null || !event.target.files || !event.target.files.length) {
+            return;
+        }
+        event.stopPropagation();
+        uploadFiles(zone, event.target.files).catch(console.error);
+        event.target.value = "";
+    }, true);
+})();
@@ -0,0 +1,123 @@
+from functools import lru_cache
+
+import mne
+
+channels_names_21 = [
+    # Frontal Pole
+    "Fp1", "Fp2",
+    # Frontal
+    "F3", "F4", "F7", "F8", "Fz",
+    # Temporal
+    "T3", "T4", "T5", "T6",
+    # Central
+    "C3", "C4", "Cz",
+    # Parietal
+    "P3", "P4", "Pz",
+    # Occipital
+    "O1", "O2",
+]
+
+channels_names_68 = [
+    # Frontal Pole
+    "Fp1", "Fp2", "AF7", "AF3", "AF4", "AF8", "F9", "F10",
+    # Frontal
+    "Fz", "F7", "F3", "F1", "F2", "F4", "F8", "F5", "F6",
+    # Frontotemporal
+    "FT9", "FT7", "FT8", "FT10",
+    # Central
+    "Cz", "C3", "C1", "C2", "C4", "C5", "C6",
+    # Temporal
+    "T9", "T7", "T8", "T10",
+    # Central-Parietal
+    "CPZ", "CP1", "CP3", "CP5", "CP2", "CP4", "CP6",
+    # Temporal-Parietal
+    "TP9", "TP7", "TP8", "TP10",
+    # Parietal
+    "Pz", "P3", "P1", "P2", "P4", "P5", "P6", "P7", "P8", "P9", "P10",
+    # Occipital
+    "OZ", "O1", "O2", "PO7", "PO3", "POZ", "PO4", "PO8",
+] # 68 channels
+
+# hardcoded names of numeric columns in uploaded tables
+default_channel_names = ['Fp1', 'Fp2', 'F3', 'F4', 'F7', 'F8', 'T3', 'T4', 'C3', 'C4', 'T5', 'T6', 'P3', 'P4', 'O1', 'O2', 'Fz', 'Cz', 'Pz']
+
+# old 10-20 names and their 10-10 equivalents (upper case), both ways
+aliases = {"T3": "T7", "T4": "T8", "T5": "P7", "T6": "P8"}
+aliases.update({new: old for old, new in list(aliases.items())})
+
+
+@lru_cache(maxsize=64)
+def channel_map(ch_names:tuple):
+    """
+    Name -> index of channels of a recording (or montage), built once per channel layout
+    Names can also be looked up in upper case and by alias (T3/T7, CPZ/CPz),
+    exact names win over case and alias matches
+    """
+    index = {}
+    for i, name in enumerate(ch_names):
+        index.setdefault(name, i)
+    for i, name in enumerate(ch_names):
+        index.setdefault(name.upper(), i)
+    for i, name in enumerate(ch_names):
+        if name.upper() in aliases:
+            index.setdefault(aliases[name.upper()], i)
+    return index
+
+def lookup(index, name):
+    # Index of name in channel_map (exact, case insensitive or alias) or None
+    i = index.get(name)
+    if i is None:
+        upper = name.upper()
+        i = index.get(upper, index.get(aliases.get(upper)))
+    return i
+
+def channel_index(ch_names, name):
+    return lookup(channel_map(tuple(ch_names)), name)
+
+def channel_indices(ch_names, names):
+    # Indices of names found in ch_names, unknown names are skipped
+    index = channel_map(tuple(ch_names))
+    return [i for i in (lookup(index, name) for name in names) if i is not None]
+
+# layouts offered in the UI and used for uploaded tables, resolved without building maps per request
+for layout in (channels_names_21, channels_names_68, default_channel_names):
+    channel_map(tuple(layout))
+
+
+@lru_cache(maxsize=1)
+def standard_montage():
+    # 10-20 montage is built once per process (before fork with gunicorn --preload)
+    return mne.channels.make_standard_montage('standard_1020')
+
+def set_mont(data_ch:list):
+    """
+    Change montage if mne_object doesn't have one
+    Standard montage is 10-20
+    """
+    # subsets are cached, every caller gets its own copy
+    return subset_montage(tuple(data_ch)).copy()
+
+@lru_cache(maxsize=32)
+def subset_montage(data_ch:tuple):
+    """
+    10-20 montage of the channels in data_ch, named as in data_ch
+    Names are matched by channel_index, so CPZ gets the position of CPz and T7 of T3 if needed
+    Channels outside 10-20 (e.g. T1) are left out
+    """
+    mont1020 = standard_montage()
+    index = channel_map(tuple(mont1020.ch_names))
+    kept = []
+    for name in dict.fromkeys(data_ch):
+        i = lookup(index, name)
+        if i is not None:
+            kept.append((name, i))
+    mont1020_new = mont1020.copy()
+    mont1020_new.ch_names = [name for name, _ in kept]
+    # Keep the first three rows as they are the fiducial points information
+    mont1020_new.dig = mont1020.dig[0:3] + [mont1020.dig[i + 3] for _, i in kept]
+    return mont1020_new
+
+def warm_up():
+    # Montages of the built-in layouts, called before fork like data_acc.warm_up
+    for layout in (channels_names_21, channels_names_68, default_channel_names):
+        subset_montage(tuple(layout))
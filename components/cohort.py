@@ -0,0 +1,129 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import json
+import os
+import uuid
+
+import mne
+import numpy as np
+
+from components.data_acc import bands_freq, bands_names, compute_band_powers, compute_spectrum, data_folder, load_cached_quality, load_cached_spectrum, load_recording, save_cached_quality, save_cached_spectrum, set_mont
+from components.helpers import is_valid_id, track_file
+from components.metrics import metrics, stage
+from components.quality import assess_quality
+from components.topomap import empty_topomap, plot_topomaps
+
+
+def process_subject(file_path, file_name):
+    """
+    Parse one recording of a cohort and compute its PSD, both are cached by content like single uploads
+    Runs in a pool process, only the band power matrix (n_channels, n_bands) is sent back,
+    bad windows are left out of the PSD like in the upload pipeline
+    """
+    with stage("cohort.subject"):
+        upload_id, recording, raw = load_recording(file_path, file_name)
+        quality = load_cached_quality(upload_id)
+        if quality is None:
+            quality = assess_quality(recording, raw.info['sfreq'])
+            save_cached_quality(upload_id, quality)
+        if load_cached_spectrum(upload_id, raw.info) is None:
+            save_cached_spectrum(upload_id, compute_spectrum(recording, raw.info, quality=quality))
+        power = compute_band_powers(load_cached_spectrum(upload_id, raw.info))["power"]
+        power[quality["bad_channels"]] = np.nan # bad channels don't count in cohort statistics
+    metrics.merge() # pool process ends with the cohort, numbers are merged subject by subject
+    return {"upload_id": upload_id, "file_name": file_name, "ch_names": raw.info['ch_names'], "power": power.tolist()}
+
+def process_cohort(session_id, files, report=None, max_workers=None):
+    """
+    Process list of (file_path, file_name) on all cores and save band power of every subject
+    to data/cohort_<session_id>.json, report(done, total) is called after every file
+    Files that can't be read are skipped, returns dict with n_subjects and failed [file name, error] pairs
+    """
+    subjects, failed = [], []
+    max_workers = max(1, min(len(files), max_workers or os.cpu_count() or 1))
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(process_subject, file_path, file_name): file_name for file_path, file_name in files}
+        for done, future in enumerate(as_completed(futures), 1):
+            try:
+                subjects.append(future.result())
+            except Exception as e:
+                print(f"Error processing {futures[future]}: {e}")
+                failed.append([futures[future], str(e)])
+            if report is not None:
+                report(done, len(futures))
+    subjects.sort(key=lambda subject: subject["file_name"])
+    save_cohort(session_id, subjects)
+    return {"n_subjects": len(subjects), "failed": failed, "upload_ids": [subject["upload_id"] for subject in subjects]}
+
+def cohort_path(session_id):
+    if not is_valid_id(session_id):
+        raise ValueError(f"Invalid session id: {session_id}")
+    return os.path.join(data_folder, f"cohort_{session_id}.json")
+
+def save_cohort(session_id, subjects):
+    file_path = cohort_path(session_id)
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(subjects, f)
+    os.replace(tmp_path, file_path)
+    track_file(os.path.basename(file_path))
+
+def load_cohort(session_id):
+    # Returns list of subjects with upload_id, file_name, ch_names and power or None if no cohort was processed
+    try:
+        with open(cohort_path(session_id), "r") as f:
+            return json.load(f) or None
+    except (ValueError, FileNotFoundError):
+        return None
+
+def cohort_powers(subjects):
+    """
+    Band power of all subjects on the union of their channels (in order of appearance)
+    Returns channel names and array (n_subjects, n_channels, n_bands), NaN where a subject lacks a channel
+    """
+    channels = list(dict.fromkeys(ch for subject in subjects for ch in subject["ch_names"]))
+    index = {ch: i for i, ch in enumerate(channels)}
+    powers = np.full((len(subjects), len(channels), len(bands_names)), np.nan)
+    for i, subject in enumerate(subjects):
+        powers[i, [index[ch] for ch in subject["ch_names"]]] = subject["power"]
+    return channels, powers
+
+def cohort_columns(subjects):
+    # Long-format (subject, channel, band, power) table, channels a subject lacks are left out
+    channels, powers = cohort_powers(subjects)
+    subject, channel, band = np.meshgrid(np.arange(len(subjects)), np.arange(len(channels)), np.arange(len(bands_names)), indexing="ij")
+    present = ~np.isnan(powers)
+    return {
+        "subject": np.asarray([s["file_name"] for s in subjects])[subject[present]],
+        "channel": np.asarray(channels)[channel[present]],
+        "band": np.asarray(bands_names)[band[present]],
+        "power": powers[present],
+    }
+
+def cohort_statistic(subjects, statistic="mean"):
+    """
+    Mean or SD across subjects of band power in dB, returns channel names and array (n_channels, n_bands)
+    Channels with too few subjects for the statistic are left out
+    """
+    channels, powers = cohort_powers(subjects)
+    values = 10 * np.log10(np.maximum(powers, np.finfo(float).tiny)) # dB, NaN stays NaN
+    counts = np.sum(~np.isnan(values[:, :, 0]), axis=0)
+    keep = counts >= (2 if statistic == "sd" else 1)
+    values = values[:, keep]
+    if statistic == "sd":
+        result = np.nanstd(values, axis=0, ddof=1)
+    else:
+        result = np.nanmean(values, axis=0)
+    return [ch for ch, kept in zip(channels, keep) if kept], result
+
+def plot_cohort_topomaps(subjects, statistic="mean"):
+    # Topomaps of cohort mean or SD for all bands
+    if statistic == "sd" and len(subjects) < 2:
+        return empty_topomap("Standard deviation needs at least 2 subjects")
+    channels, values = cohort_statistic(subjects, statistic)
+    info = mne.create_info(channels, 1.0, ch_types="eeg")
+    info.set_montage(set_mont(channels), on_missing="ignore") # channels outside 10-20 have no position
+    titles = [f"{name} ({fmin} - {fmax} Hz)" for name, (fmin, fmax) in zip(bands_names, bands_freq)]
+    label = "SD of power (dB)" if statistic == "sd" else "Mean power (dB)"
+    fig = plot_topomaps(info, values, titles, colorbar_title=label)
+    fig.update_layout(title=f"Cohort {'SD' if statistic == 'sd' else 'mean'} ({len(subjects)} subjects)")
+    return fig
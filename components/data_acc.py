@@ -1,56 +1,24 @@
-import base64
-import datetime
-import io
+import hashlib
 import json
 import mne
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
 import os
 import uuid
-import pyxdf
+from numpy.lib.stride_tricks import sliding_window_view
 
-from components.helpers import create_file
+from components.channels import channel_index, channel_indices, channels_names_21, channels_names_68, default_channel_names, set_mont
+from components.channels import warm_up as warm_up_channels
+from components.helpers import track_file, untrack_file
+from components.metrics import instrument
+from components.quality import good_segments
+from components.recording import Recording
+from components.topomap import plot_topomaps
+from components.xdf import effective_srate, find_stream, read_stream, scan_xdf
 
 # Define constants
 data_folder = os.path.join(os.getcwd(), "data")
 
-channels_names_21 = [
-    # Frontal Pole
-    "Fp1", "Fp2",
-    # Frontal
-    "F3", "F4", "F7", "F8", "Fz",
-    # Temporal
-    "T3", "T4", "T5", "T6",
-    # Central
-    "C3", "C4", "Cz",
-    # Parietal
-    "P3", "P4", "Pz",
-    # Occipital
-    "O1", "O2",
-]
-
-channels_names_68 = [
-    # Frontal Pole
-    "Fp1", "Fp2", "AF7", "AF3", "AF4", "AF8", "F9", "F10",
-    # Frontal
-    "Fz", "F7", "F3", "F1", "F2", "F4", "F8", "F5", "F6",
-    # Frontotemporal
-    "FT9", "FT7", "FT8", "FT10",
-    # Central
-    "Cz", "C3", "C1", "C2", "C4", "C5", "C6",
-    # Temporal
-    "T9", "T7", "T8", "T10",
-    # Central-Parietal
-    "CPZ", "CP1", "CP3", "CP5", "CP2", "CP4", "CP6",
-    # Temporal-Parietal
-    "TP9", "TP7", "TP8", "TP10",
-    # Parietal
-    "Pz", "P3", "P1", "P2", "P4", "P5", "P6", "P7", "P8", "P9", "P10",
-    # Occipital
-    "OZ", "O1", "O2", "PO7", "PO3", "POZ", "PO4", "PO8",
-] # 68 channels
-
 delta = [0.5,4] # Delta:   0.5 – 4   Hz   → Deep sleep, unconscious states
 theta = [4,8] # Theta:   4   – 8   Hz   → Drowsiness, meditation, creativity
 alpha = [8,13] # Alpha:   8   – 13  Hz   → Relaxed wakefulness, calm focus
@@ -59,69 +27,186 @@ gamma = [30,100] # Gamma:   30  – 100 Hz   → Higher cognitive functions, mem
 bands_freq = [delta, theta, alpha, beta, gamma]
 bands_names = ['Delta', 'Theta', 'Alpha', 'Beta', 'Gamma']
 
+plot_width_px = 2000 # horizontal resolution the raw signal is decimated to
+segment_seconds = 2.0 # length of Welch segments for band power over time, they overlap by half
+segment_block = 256 # segments transformed at once, bounds memory of the FFT
+connectivity_measures = {"coherence": "Coherence", "plv": "Phase-Locking Value"}
 
-def construct_mne_object():
-    # Create an empty Raw object with specified channels
-    n_channels = 1  
-    # Create empty data (0 samples)
-    data = np.zeros((n_channels, 0))
-    # Create minimal info
-    info = mne.create_info(["None"], 256, ch_types="eeg")
-    # Create Raw object
-    mne_raw = mne.io.RawArray(data, info)
-    return mne_raw
 
-def get_file(contents, file_name: str):
-    # Returns pandas DataFrame and column names from decoded contents
-    # contents are decoded from uploaded file
- 
-    # decode contents
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
+def load_recording(file_path: str, file_name: str):
+    """
+    Returns content hash of the file, float32 data of shape (n_channels, n_times) and mne object
+    Parsed data is cached under data/ by content hash, repeated uploads skip parsing
+    and read the data as memory-mapped array
+    """
+    key = file_hash(file_path)
+    cached = load_cached_recording(key)
+    if cached is None:
+        save_cached_recording(key, read_file(file_path, file_name))
+        cached = load_cached_recording(key)
+    data = cached[0]
+    return key, data, recording2mne(*cached)
+
+def recording2mne(data, sfreq, ch_names, ch_types):
+    # Wrap cached recording into mne object, samples stay on disk until they are requested
+    return Recording(data, sfreq, ch_names, ch_types).to_mne()
+
+def file_hash(file_path: str, block_size=1024**2):
+    # Hash file content without reading it whole
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+def save_cached_recording(key: str, recording:Recording):
+    """
+    Store data of recording as data/<key>.npy (float32) and its metadata as data/<key>.json
+    Memory-mapped reader output (EDF) is moved to the cache without another copy
+    Both files are tracked as temporary files
+    """
+    def write_data(path):
+        data = recording.data
+        # open_memmap reports mode r+ for the file it created, caches loaded read-only are copied
+        if isinstance(data, np.memmap) and data.mode in ("r+", "w+") and data.filename is not None:
+            data.flush()
+            os.replace(data.filename, path)
+            untrack_file(os.path.relpath(data.filename, data_folder)) # only the cache name is counted against the quota
+        else:
+            with open(path, "wb") as f:
+                np.save(f, data)
+
+    def write_meta(path):
+        with open(path, "w") as f:
+            json.dump({
+                "sfreq": recording.sfreq,
+                "ch_names": recording.ch_names,
+                "ch_types": recording.ch_types,
+            }, f)
+
+    for file_name, write in ((f"{key}.npy", write_data), (f"{key}.json", write_meta)):
+        # write to temporary file first so other workers never see a partial file
+        tmp_path = os.path.join(data_folder, f"{file_name}.{uuid.uuid4().hex}.tmp")
+        write(tmp_path)
+        os.replace(tmp_path, os.path.join(data_folder, file_name))
+        track_file(file_name)
+
+def load_cached_recording(key: str):
+    # Returns memory-mapped data, sfreq, channel names and types or None if key isn't cached
+    data_path = os.path.join(data_folder, f"{key}.npy")
+    meta_path = os.path.join(data_folder, f"{key}.json")
+    if not os.path.exists(data_path) or not os.path.exists(meta_path):
+        return None
+    with open(meta_path, "r") as f:
+        meta = json.load(f)
+    for file_name in (f"{key}.npy", f"{key}.json"):
+        track_file(file_name) # renew expiry
+    data = np.load(data_path, mmap_mode="r")
+    return data, meta["sfreq"], meta["ch_names"], meta["ch_types"]
 
+def read_file(file_path: str, file_name: str):
+    # Returns Recording from file saved in data/
+    extension = os.path.splitext(file_name)[1].lower() # same check as upload_path, rec.CSV is a CSV
     try:
-        if file_name.endswith(".csv"):
-            raw_data = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-            raw_data = check_columns(raw_data)
-        elif file_name.endswith(".xls"): # Test needed
-            raw_data = pd.read_excel(io.BytesIO(decoded))
-            raw_data = check_columns(raw_data)
-        elif file_name.endswith(".edf"):
-            raw_data = mne.io.read_raw_edf(create_file(contents, "edf"), preload=True) # temporarily hardcoded
-        elif file_name.endswith(".xdf"):
-            raw_data = read_raw_xdf(create_file(contents, "xdf"))
+        if extension == ".csv":
+            raw_data = read_csv_stream(file_path)
+        elif extension == ".xls": # Test needed
+            raw_data = table2recording(pd.read_excel(file_path))
+        elif extension == ".edf":
+            raw_data = read_edf(file_path)
+        elif extension == ".xdf":
+            raw_data = read_raw_xdf(file_path)
         else:
-            raise TypeError
-    except ValueError:
-        # print(f"Entered path: \"{file_path}\" is not a valid CSV file.")
-        print("Error reading file. Please check the file format and content.")
+            raise ValueError(f"Unsupported file type: {extension}")
+    except ValueError as e:
+        # message (e.g. wrong number of columns) reaches the upload or cohort job
+        print(f"Error reading file {file_name}: {e}. Please check the file format and content.")
+        raise
     return raw_data
 
-def read_raw_xdf(fname:str):
-    streams, header = pyxdf.load_xdf(fname)
-    # find the stream with EEG data
-    eeg_stream = None
-    for stream in streams:
-        print(stream['info']['type'][0].lower())
-        if stream['info']['type'][0].lower() == 'eeg':
-            eeg_stream = stream
-            break
-    if eeg_stream is None:
-        raise RuntimeError("No EEG stream found in the XDF file.")
-    # prepare data and frequency
-    data = np.array(eeg_stream["time_series"]).T # shape (n_channels, n_times)
-    sfreq = float(streams[0]["info"]["nominal_srate"][0])
-    # channel names
-    if eeg_stream['info']['desc'][0] != None:
-        ch_names = [ch['label'][0] for ch in eeg_stream['info']['desc'][0]['channels'][0]['channel']]
-    else:
-        n_channels = int(eeg_stream['info']['channel_count'][0])
-        ch_names = [f"CH{i+1}" for i in range(n_channels)]
-    ch_types = ['eeg'] * len(ch_names)
-    # create mne object
-    info = mne.create_info(ch_names=ch_names, sfreq=sfreq, ch_types=ch_types)
-    raw_data = mne.io.RawArray(data, info)
-    return raw_data
+def count_lines(file_path: str, block_size=1024**2):
+    # Count lines of a text file without reading it whole
+    n_lines = 0
+    last = b"\n"
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            n_lines += block.count(b"\n")
+            last = block[-1:]
+    return n_lines + (last != b"\n") # last line without newline
+
+def read_csv_stream(file_path: str, chunk_rows=65536):
+    """
+    Parse CSV chunk by chunk straight into preallocated float32 matrix of shape (n_channels, n_times)
+    Columns are chosen like in check_columns, numeric header is treated as the first sample
+    Returns Recording
+    """
+    sample = pd.read_csv(file_path, nrows=100)
+    columns = list(sample.select_dtypes(include=['number']).columns)
+    header_is_data = is_numeric_header(columns)
+    if len(columns) != len(default_channel_names):
+        raise ValueError(f"Expected {len(default_channel_names)} numeric columns, got {len(columns)}")
+
+    n_times = count_lines(file_path) - 1 + header_is_data
+    data = np.empty((len(columns), n_times), dtype=np.float32)
+    pos = 0
+    if header_is_data:
+        data[:, 0] = [float(col) for col in columns]
+        pos = 1
+    for chunk in pd.read_csv(file_path, usecols=columns, dtype=np.float32, chunksize=chunk_rows):
+        values = chunk[columns].to_numpy()
+        data[:, pos:pos + len(values)] = values.T
+        pos += len(values)
+    data = data[:, :pos] # blank lines aren't samples
+    return Recording(data, 256, default_channel_names)
+
+def is_numeric_header(columns):
+    # header without letters is the first sample of a file without column names
+    return not any(any(char.isalpha() for char in str(col)) for col in columns)
+
+def table2recording(table:pd.DataFrame, sfreq=256):
+    """
+    Recording of numeric table columns chosen like in check_columns, without intermediate DataFrames
+    Numeric header is treated as the first sample
+    """
+    numeric = table.select_dtypes(include=['number'])
+    header_is_data = is_numeric_header(numeric.columns)
+    data = np.empty((numeric.shape[1], len(numeric) + header_is_data), dtype=np.float32)
+    if header_is_data:
+        data[:, 0] = [float(col) for col in numeric.columns]
+    data[:, int(header_is_data):] = numeric.to_numpy(dtype=np.float32).T
+    return Recording(data, sfreq, default_channel_names)
+
+def read_edf(file_path: str):
+    """
+    Read EDF block by block into float32 matrix memory-mapped from a temporary .npy in data/
+    RAM doesn't grow with recording length, the file becomes the recording cache
+    """
+    raw = mne.io.read_raw_edf(file_path, preload=False)
+    file_name = f"{uuid.uuid4().hex}.npy"
+    out = np.lib.format.open_memmap(os.path.join(data_folder, file_name), mode="w+", dtype=np.float32, shape=(len(raw.ch_names), int(raw.n_times)))
+    recording = Recording.from_mne(raw, out)
+    track_file(file_name)
+    return recording
+
+def read_raw_xdf(fname:str, stream_type="eeg", clock_sync=False):
+    """
+    Read only the EEG stream of an XDF file into float32 matrix memory-mapped from a temporary .npy in data/
+    Chunk headers are scanned first, so the matrix is allocated once and samples of other
+    streams (markers, accelerometer, video) are never decoded
+    sfreq is the nominal rate of the EEG stream, with clock_sync (or without nominal rate)
+    it's measured from timestamps corrected by the recorded clock offsets
+    """
+    streams = scan_xdf(fname)
+    eeg_stream = find_stream(streams, stream_type)
+    if eeg_stream["n_samples"] == 0:
+        raise RuntimeError("EEG stream in the XDF file has no samples.")
+    file_name = f"{uuid.uuid4().hex}.npy"
+    out = np.lib.format.open_memmap(os.path.join(data_folder, file_name), mode="w+", dtype=np.float32, shape=(eeg_stream["n_channels"], int(eeg_stream["n_samples"])))
+    track_file(file_name)
+    measure_rate = clock_sync or eeg_stream["srate"] <= 0
+    data, timestamps = read_stream(fname, eeg_stream, out, with_timestamps=measure_rate, clock_sync=clock_sync)
+    sfreq = effective_srate(timestamps) if measure_rate else eeg_stream["srate"]
+    return Recording(data, sfreq, eeg_stream["ch_names"])
 
 def check_columns(import_data:pd.DataFrame):
     # filter data and choose appropriate column names
@@ -142,41 +227,262 @@ def check_columns(import_data:pd.DataFrame):
         df = pd.concat([column_names_row, df], ignore_index=True)
 
     # hardcoded
-    channel_names = ['Fp1', 'Fp2', 'F3', 'F4', 'F7', 'F8', 'T3', 'T4', 'C3', 'C4', 'T5', 'T6', 'P3', 'P4', 'O1', 'O2', 'Fz', 'Cz', 'Pz']
-    df.columns = channel_names
+    df.columns = default_channel_names
 
     # uncomment to defy hardcoding
     # df.columns = channels_info
     return df
 
 def pd2mne(raw_data:pd.DataFrame):
-    # Convert DataFrame to mne object
+    # Convert DataFrame or Recording to mne object
+    if isinstance(raw_data, Recording):
+        return raw_data.to_mne()
     if not isinstance(raw_data, pd.DataFrame):
         return raw_data
     info = mne.create_info(list(raw_data.columns), 256, ch_types="eeg")
-    mne_raw = mne.io.RawArray(raw_data.T, info)
+    mne_raw = mne.io.RawArray(raw_data.to_numpy(dtype=np.float64).T, info) # transposed view, not a transposed copy
     return mne_raw
 
 def calculate_psd(raw_data:pd.DataFrame):
     # Create MNE Raw object and calculate PSD
-    mne_raw = pd2mne(raw_data)
+    mne_raw = set_default_montage(pd2mne(raw_data))
+    psd = mne_raw.compute_psd()
+    return psd, mne_raw.info['ch_names']
+
+@instrument()
+def compute_spectrum(data, info:mne.Info, n_fft=2048, block_seconds=60, quality=None):
+    """
+    Welch PSD of data (n_channels, n_times) like compute_psd defaults of calculate_psd
+    (Hamming window of n_fft samples without overlap, mean of segments)
+    Data is read block by block, so memory doesn't grow with recording length
+    Segments overlapping bad windows of quality (assess_quality) are left out, unless all of them are bad
+    Returns mne Spectrum with given info
+    """
+    sfreq = info['sfreq']
+    n_fft = min(n_fft, data.shape[1])
+    from scipy.signal import get_window # scipy.signal is slow to import, loaded on first PSD
+    window = get_window("hamming", n_fft)
+    n_segments = data.shape[1] // n_fft
+    keep = good_segments(quality, sfreq, n_fft, n_segments)
+    if not keep.any():
+        keep[:] = True
+    block = max(1, int(block_seconds * sfreq) // n_fft) * n_fft
+    total = np.zeros((data.shape[0], n_fft // 2 + 1))
+    for start in range(0, n_segments * n_fft, block):
+        stop = min(start + block, n_segments * n_fft)
+        kept = keep[start // n_fft:stop // n_fft]
+        if not kept.any():
+            continue
+        segments = np.asarray(data[:, start:stop], dtype=np.float64).reshape(data.shape[0], -1, n_fft)
+        if not kept.all():
+            segments = segments[:, kept]
+        total += periodograms(segments, sfreq, window).sum(axis=1)
+    return mne.time_frequency.SpectrumArray(total / keep.sum(), info.copy(), np.fft.rfftfreq(n_fft, 1 / sfreq))
+
+def periodograms(segments, sfreq, window):
+    # One-sided PSD of every segment (..., n_samples) after removing its mean, scaled like scipy.signal.welch
+    segments = segments - segments.mean(axis=-1, keepdims=True)
+    psd = np.abs(np.fft.rfft(segments * window, axis=-1)) ** 2 * (2 / (sfreq * np.sum(window ** 2)))
+    psd[..., 0] /= 2 # DC and Nyquist aren't doubled
+    if segments.shape[-1] % 2 == 0:
+        psd[..., -1] /= 2
+    return psd
+
+def set_default_montage(mne_raw):
     # set_montage if it doesn't have it 
     if mne_raw.get_montage() is None:
         new_mon = set_mont(mne_raw.ch_names)
-        mne_raw.set_montage(new_mon)
-    psd = mne_raw.compute_psd()
-    return psd, mne_raw.info['ch_names']
+        mne_raw.set_montage(new_mon, on_missing="warn") # channels outside 10-20 have no position
+    return mne_raw
+
+def save_cached_spectrum(key: str, spectrum:mne.time_frequency.Spectrum):
+    # Store PSD of a cached recording as data/<key>_psd.npz
+    psd, freqs = spectrum.get_data(exclude=(), return_freqs=True)
+    file_name = f"{key}_psd.npz"
+    tmp_path = os.path.join(data_folder, f"{file_name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, psd=psd, freqs=freqs)
+    os.replace(tmp_path, os.path.join(data_folder, file_name))
+    track_file(file_name)
+
+def load_cached_spectrum(key: str, info:mne.Info):
+    # Returns Spectrum of a cached recording with given (montage) info or None if it isn't computed yet
+    file_path = os.path.join(data_folder, f"{key}_psd.npz")
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as cached:
+        return mne.time_frequency.SpectrumArray(cached["psd"], info.copy(), cached["freqs"])
+
+def save_cached_quality(key: str, quality:dict):
+    # Store bad channels and windows of a cached recording as data/<key>_quality.npz
+    file_name = f"{key}_quality.npz"
+    tmp_path = os.path.join(data_folder, f"{file_name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **quality)
+    os.replace(tmp_path, os.path.join(data_folder, file_name))
+    track_file(file_name)
+
+def load_cached_quality(key: str):
+    # Returns quality of a cached recording (see assess_quality) or None if it isn't assessed yet
+    file_path = os.path.join(data_folder, f"{key}_quality.npz")
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as cached:
+        return {"bad_channels": cached["bad_channels"], "bad_windows": cached["bad_windows"], "window_seconds": float(cached["window_seconds"])}
 
 def get_power_band(spectrum:mne.time_frequency.Spectrum, band:list):
     fmin, fmax = band
-    power, freqs = spectrum.get_data(return_freqs=True, fmin=fmin, fmax=fmax)
+    power, freqs = spectrum.get_data(exclude=(), return_freqs=True, fmin=fmin, fmax=fmax)
     return power, freqs
 
 def extract_all_power_bands(spectrum:mne.time_frequency.Spectrum):
-    power_bands = []
-    for band in bands_freq:
-        power_bands.append(get_power_band(spectrum, band))
-    return power_bands
+    # list of (power, freqs) for every band in bands_freq
+    return compute_band_powers(spectrum)["bands"]
+
+def compute_band_powers(spectrum:mne.time_frequency.Spectrum):
+    """
+    Fetch PSD matrix once and split it into all bands from bands_freq
+    Returns dict with:
+    psd (n_channels, n_freqs) and freqs of the whole spectrum,
+    slices - frequency bin range of every band,
+    bands - (power, freqs) views of every band like get_power_band,
+    power - integrated band power (n_channels, n_bands) using trapezoid rule,
+    relative - power divided by total power from the lowest to the highest band edge
+    """
+    psd, freqs = spectrum.get_data(exclude=(), return_freqs=True)
+    slices = band_slices(freqs)
+    power = np.stack([np.trapezoid(psd[:, sl], freqs[sl], axis=1) for sl in slices], axis=1)
+    total = np.trapezoid(psd[:, slices[0].start:slices[-1].stop], freqs[slices[0].start:slices[-1].stop], axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        relative = power / total[:, None]
+    return {
+        "psd": psd,
+        "freqs": freqs,
+        "slices": slices,
+        "bands": [(psd[:, sl], freqs[sl]) for sl in slices],
+        "power": power,
+        "relative": relative,
+    }
+
+def band_slices(freqs):
+    # Bins with fmin <= freq <= fmax for every band, same as Spectrum.get_data(fmin, fmax)
+    return [slice(np.searchsorted(freqs, fmin, side="left"), np.searchsorted(freqs, fmax, side="right")) for fmin, fmax in bands_freq]
+
+def segment_band_powers(data, sfreq, seg_seconds=segment_seconds):
+    """
+    Band power of every Welch segment (n_channels, n_segments, n_bands)
+    Segments are strided views of data with half overlap, Hann window and one-sided PSD scaling like scipy.signal.welch
+    Returns band powers, segment length and step in samples
+    """
+    nperseg = max(2, min(int(round(seg_seconds * sfreq)), data.shape[1]))
+    step = nperseg // 2
+    segments = sliding_window_view(data, nperseg, axis=1)[:, ::step] # no copy
+    from scipy.signal import get_window
+    window = get_window("hann", nperseg)
+    freqs = np.fft.rfftfreq(nperseg, 1 / sfreq)
+    slices = band_slices(freqs)
+    powers = np.empty((data.shape[0], segments.shape[1], len(slices)), dtype=np.float32)
+    for start in range(0, segments.shape[1], segment_block):
+        psd = periodograms(np.asarray(segments[:, start:start + segment_block], dtype=np.float64), sfreq, window)
+        for b, sl in enumerate(slices):
+            powers[:, start:start + segment_block, b] = np.trapezoid(psd[..., sl], freqs[sl], axis=2)
+    return powers, nperseg, step
+
+@instrument()
+def compute_segment_powers(data, sfreq, seg_seconds=segment_seconds):
+    """
+    Segment band powers of the whole recording computed once
+    Returns dict with:
+    power - band power of every segment (n_channels, n_segments, n_bands),
+    cumsum - prefix sums over segments (n_channels, n_segments + 1, n_bands), any window is a difference of two rows,
+    times - centre of every segment in seconds, step - seconds between segments
+    """
+    powers, nperseg, step = segment_band_powers(data, sfreq, seg_seconds)
+    cumsum = np.zeros((powers.shape[0], powers.shape[1] + 1, powers.shape[2]))
+    np.cumsum(powers, axis=1, out=cumsum[:, 1:])
+    return {
+        "power": powers,
+        "cumsum": cumsum,
+        "times": (np.arange(powers.shape[1]) * step + nperseg / 2) / sfreq,
+        "step": step / sfreq,
+    }
+
+def moving_band_power(segment_powers, band_index, window_seconds):
+    """
+    Band power averaged over a window sliding by one segment, for all channels
+    Returns window centres in seconds and power (n_channels, n_windows)
+    """
+    times = segment_powers["times"]
+    n = int(np.clip(round(window_seconds / segment_powers["step"]), 1, len(times)))
+    cumsum = segment_powers["cumsum"][:, :, band_index]
+    power = (cumsum[:, n:] - cumsum[:, :-n]) / n
+    return (times[n - 1:] + times[:len(times) - n + 1]) / 2, power
+
+@instrument()
+def compute_connectivity(data, sfreq, seg_seconds=segment_seconds, quality=None):
+    """
+    Coherence and phase-locking value of all channel pairs in every band of bands_freq
+    Data is cut into consecutive segments of seg_seconds, all channels and segments of a block
+    are transformed by one FFT and cross-spectra of all pairs are a matrix product per frequency bin
+    Segments overlapping bad windows of quality are left out, unless all of them are bad
+    Returns dict with coherence and plv (n_channels, n_channels, n_bands), measures are averaged over bins of a band
+    """
+    nperseg = max(2, min(int(round(seg_seconds * sfreq)), data.shape[1]))
+    n_segments = data.shape[1] // nperseg
+    keep = good_segments(quality, sfreq, nperseg, n_segments)
+    if not keep.any():
+        keep[:] = True
+    from scipy.signal import get_window
+    window = get_window("hann", nperseg)
+    slices = band_slices(np.fft.rfftfreq(nperseg, 1 / sfreq))
+    bins = slice(slices[0].start, slices[-1].stop) # only bins inside bands are accumulated
+    n_bins = bins.stop - bins.start
+    cross = np.zeros((n_bins, data.shape[0], data.shape[0]), dtype=np.complex128)
+    phase = np.zeros_like(cross)
+    for start in range(0, n_segments, segment_block):
+        stop = min(start + segment_block, n_segments)
+        kept = keep[start:stop]
+        if not kept.any():
+            continue
+        segments = np.asarray(data[:, start * nperseg:stop * nperseg], dtype=np.float64).reshape(data.shape[0], -1, nperseg)[:, kept]
+        segments = segments - segments.mean(axis=2, keepdims=True)
+        # (n_bins, n_channels, n_segments), contiguous so the products run in BLAS
+        spectra = np.ascontiguousarray(np.fft.rfft(segments * window, axis=2)[:, :, bins].transpose(2, 0, 1))
+        cross += spectra @ spectra.conj().transpose(0, 2, 1)
+        magnitude = np.abs(spectra)
+        phasors = np.divide(spectra, magnitude, out=np.zeros_like(spectra), where=magnitude > 0)
+        phase += phasors @ phasors.conj().transpose(0, 2, 1)
+    auto = np.real(np.diagonal(cross, axis1=1, axis2=2))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        coherence = np.nan_to_num(np.abs(cross) ** 2 / (auto[:, :, None] * auto[:, None, :]))
+    plv = np.abs(phase) / keep.sum()
+    band_bins = [slice(sl.start - bins.start, sl.stop - bins.start) for sl in slices]
+    return {
+        "coherence": np.stack([coherence[sl].mean(axis=0) for sl in band_bins], axis=2).astype(np.float32),
+        "plv": np.stack([plv[sl].mean(axis=0) for sl in band_bins], axis=2).astype(np.float32),
+    }
+
+def save_cached_connectivity(key: str, connectivity:dict):
+    # Store connectivity of a cached recording as data/<key>_conn.npz
+    file_name = f"{key}_conn.npz"
+    tmp_path = os.path.join(data_folder, f"{file_name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **connectivity)
+    os.replace(tmp_path, os.path.join(data_folder, file_name))
+    track_file(file_name)
+
+def load_cached_connectivity(key: str):
+    # Returns connectivity of a cached recording (see compute_connectivity) or None if it isn't computed yet
+    file_path = os.path.join(data_folder, f"{key}_conn.npz")
+    if not os.path.exists(file_path):
+        return None
+    with np.load(file_path) as cached:
+        return {measure: cached[measure] for measure in connectivity_measures}
+
+def connectivity_matrix(connectivity, measure, band_name, indices):
+    # Matrix of one measure in one band between channels at indices
+    values = connectivity[measure][:, :, get_band_index(band_name)]
+    return values[np.ix_(indices, indices)]
 
 def power_band2csv(power_bands:list, channels:list):
     pw_dic = {}
@@ -198,76 +504,242 @@ def power_band2csv(power_bands:list, channels:list):
     df = pd.DataFrame(pw_dic)
     return df
 
-def set_mont(data_ch:list):
-    """
-    Change montage if mne_object doesn't have one
-    Standard montage is 10-20
-    """
-    # Form the 10-20 montage
-    mont1020 = mne.channels.make_standard_montage('standard_1020')
-    # Choose what chann`els you want to keep 
-    # Make sure that these channels exist e.g. T1 does not exist in the standard 10-20 EEG system!
-    kept_channels = data_ch 
-    ind = [i for (i, channel) in enumerate(mont1020.ch_names) if channel in kept_channels]
-    mont1020_new = mont1020.copy()
-    # Keep only the desired channels
-    mont1020_new.ch_names = [mont1020.ch_names[x] for x in ind]
-    kept_channel_info = [mont1020.dig[x+3] for x in ind]
-    # Keep the first three rows as they are the fiducial points information
-    mont1020_new.dig = mont1020.dig[0:3]+kept_channel_info
-    # mont1020.plot()
-    # mont1020_new.plot()
-    return mont1020_new
-
-def create_top_map(psd_data:mne.time_frequency.spectrum.Spectrum):
-    # topo_fig = psd_data.plot_topomap(ch_type='eeg', show=False, size=100, res=100)
-    topo_fig = psd_data.plot_topomap(ch_type='eeg', show=False)
-    #TODO: adjust to monitor resolution
-    screen_width_px = 1620 
-    screen_height_px = 1080 
-    dpi = 100  
-
-    width_in = screen_width_px / dpi
-    height_in = screen_height_px / dpi
-
-    topo_fig.set_size_inches(width_in, height_in)
-    return topo_fig
+def power_band_columns(band_powers, channels:list):
+    """
+    Long-format (channel, band, freq, power) table of every PSD bin in every band
+    Columns are built from compute_band_powers arrays without padding, rows go band by band, channel by channel
+    """
+    psd, freqs = band_powers["psd"], band_powers["freqs"]
+    columns = {"channel": [], "band": [], "freq": [], "power": []}
+    for band, sl in zip(bands_names, band_powers["slices"]):
+        n_freqs = sl.stop - sl.start
+        columns["channel"].append(np.repeat(np.asarray(channels), n_freqs))
+        columns["band"].append(np.full(len(channels) * n_freqs, band))
+        columns["freq"].append(np.tile(freqs[sl], len(channels)))
+        columns["power"].append(psd[:, sl].ravel())
+    return {name: np.concatenate(parts) for name, parts in columns.items()}
+
+def warm_up():
+    """
+    Import libraries loaded lazily on first use and build static data
+    Called in gunicorn master before fork, so workers share them
+    """
+    import scipy.signal
+    import mne.filter
+    import mne.time_frequency
+    warm_up_channels()
+
+def get_band_index(band_name):
+    for i, name in enumerate(bands_names):
+        if band_name.lower() == name.lower():
+            return i
+    raise ValueError(f"Unknown band: {band_name}")
+
 ###
 ### Specific Vizaulization Functions
 ###
 
 # Function to plot the raw signal for one or more channels
-def plot_raw_channels(raw, channel_names):
-    channel_indices = [raw.info['ch_names'].index(ch) for ch in channel_names if ch in raw.info['ch_names']]
-    if not channel_indices:
+@instrument()
+def plot_raw_channels(raw, channel_names, x_range=None, n_px=plot_width_px, pyramid=None):
+    """
+    Return times and data of the selected channels decimated to n_px pixels
+    If x_range is given only the visible part (plus a margin for panning) is read
+    If pyramid of raw is given the answer comes from its best level instead of raw samples
+    """
+    indices = channel_indices(raw.info['ch_names'], channel_names)
+    if not indices:
         raise ValueError(f"None of the selected channels were found in the data.")
-    
-    data, times = raw[channel_indices]
-    return times, data
+
+    start, stop = get_sample_range(x_range, raw.info['sfreq'], raw.n_times)
+    if pyramid is not None:
+        decimated = query_pyramid(pyramid, indices, start, stop, n_px)
+        if decimated is not None:
+            return decimated
+    data, times = raw[indices, start:stop]
+    return decimate_minmax(times, data, n_px)
+
+def plot_signal_range(data, sfreq, x_range=None, n_px=plot_width_px):
+    # Same as plot_raw_channels but for already extracted (e.g. filtered) channel data
+    start, stop = get_sample_range(x_range, sfreq, data.shape[1])
+    times = np.arange(start, stop) / sfreq
+    return decimate_minmax(times, data[:, start:stop], n_px)
+
+def pyramid_levels(n_times, n_px=plot_width_px):
+    """
+    (factor, offset, length) of 2x, 4x, 8x ... decimation levels of a signal with n_times samples
+    Levels are built until the coarsest one still has at least n_px buckets,
+    offset is where the level starts in the stored pyramid (levels are concatenated along time)
+    """
+    levels = []
+    length, offset, factor = n_times, 0, 1
+    while length // 2 >= n_px:
+        factor *= 2
+        length = -(-length // 2)
+        levels.append((factor, offset, length))
+        offset += length
+    return levels
+
+@instrument()
+def build_pyramid(data, sfreq, n_px=plot_width_px, out=None, block_seconds=60):
+    """
+    Pre-aggregate signal of shape (n_channels, n_times) into decimation levels of pyramid_levels
+    Every level keeps min and max of its buckets, they are written to out (2, n_channels, sum of level lengths),
+    a memory-mapped array when the pyramid is cached, block by block so memory doesn't grow with recording length
+    """
+    levels = pyramid_levels(data.shape[1], n_px)
+    if out is None:
+        out = np.empty((2, data.shape[0], sum(length for _, _, length in levels)), dtype=np.float32)
+    if levels:
+        # blocks are whole buckets of the coarsest level, so only the last one can have odd length
+        coarsest = levels[-1][0]
+        block = -(-int(block_seconds * sfreq) // coarsest) * coarsest
+        for start in range(0, data.shape[1], block):
+            mins = maxs = np.asarray(data[:, start:start + block], dtype=np.float32)
+            for factor, offset, _ in levels:
+                mins, maxs = halve_level(mins, np.minimum), halve_level(maxs, np.maximum)
+                first = offset + start // factor
+                out[0, :, first:first + mins.shape[1]] = mins
+                out[1, :, first:first + maxs.shape[1]] = maxs
+    return pyramid_views(out, sfreq, data.shape[1], n_px)
+
+def pyramid_views(stored, sfreq, n_times, n_px=plot_width_px):
+    # Pyramid dict with min/max views of every level in stored (2, n_channels, sum of level lengths)
+    levels = [{"factor": factor, "min": stored[0, :, offset:offset + length], "max": stored[1, :, offset:offset + length]}
+              for factor, offset, length in pyramid_levels(n_times, n_px)]
+    return {"sfreq": sfreq, "n_times": n_times, "levels": levels}
+
+def save_cached_pyramid(key: str, data, sfreq):
+    # Build pyramid of a cached recording straight into data/<key>_pyramid.npy
+    file_name = f"{key}_pyramid.npy"
+    tmp_path = os.path.join(data_folder, f"{file_name}.{uuid.uuid4().hex}.tmp")
+    shape = (2, data.shape[0], sum(length for _, _, length in pyramid_levels(data.shape[1])))
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=shape)
+    build_pyramid(data, sfreq, out=out)
+    out.flush()
+    del out
+    os.replace(tmp_path, os.path.join(data_folder, file_name))
+    track_file(file_name)
+
+def load_cached_pyramid(key: str, sfreq, n_times):
+    # Returns memory-mapped pyramid of a cached recording or None if it isn't built yet
+    file_path = os.path.join(data_folder, f"{key}_pyramid.npy")
+    if not os.path.exists(file_path):
+        return None
+    track_file(f"{key}_pyramid.npy") # renew expiry
+    return pyramid_views(np.load(file_path, mmap_mode="r"), sfreq, n_times)
+
+def halve_level(arr, reduce):
+    # Merge neighbouring samples pairwise, odd length is padded with the last sample
+    if arr.shape[1] % 2:
+        arr = np.concatenate([arr, arr[:, -1:]], axis=1)
+    return np.ascontiguousarray(reduce(arr[:, 0::2], arr[:, 1::2]), dtype=np.float32)
+
+def query_pyramid(pyramid, channel_indices, start, stop, n_px):
+    """
+    Answer (time range, pixel budget) query from the coarsest level that still has n_px buckets
+    Returns times and data like decimate_minmax or None if raw samples are needed
+    """
+    level = None
+    for lvl in pyramid["levels"]:
+        if (stop - start) // lvl["factor"] >= n_px:
+            level = lvl
+    if level is None:
+        return None
+
+    factor = level["factor"]
+    first, last = start // factor, -(-stop // factor)
+    data = np.empty((len(channel_indices), 2 * (last - first)), dtype=np.float32)
+    data[:, 0::2] = level["min"][channel_indices, first:last]
+    data[:, 1::2] = level["max"][channel_indices, first:last]
+    # both points of a bucket are drawn at its centre
+    centres = np.minimum(np.arange(first, last) * factor + factor / 2, pyramid["n_times"] - 1) / pyramid["sfreq"]
+    times = np.repeat(centres, 2)
+    return np.broadcast_to(times, data.shape), data
+
+def get_x_range(relayout_data):
+    # Read visible x-axis range from eeg-plot relayoutData, None means full range
+    if not relayout_data or relayout_data.get("xaxis.autorange"):
+        return None
+    if "xaxis.range[0]" in relayout_data and "xaxis.range[1]" in relayout_data:
+        return [relayout_data["xaxis.range[0]"], relayout_data["xaxis.range[1]"]]
+    if "xaxis.range" in relayout_data:
+        return list(relayout_data["xaxis.range"])
+    return None
+
+def get_sample_range(x_range, sfreq, n_times):
+    # Convert time range in seconds to sample indices, half of the width is added on both sides
+    if x_range is None:
+        return 0, n_times
+    x0, x1 = sorted(float(x) for x in x_range)
+    margin = (x1 - x0) / 2
+    start = max(int(np.floor((x0 - margin) * sfreq)), 0)
+    stop = min(int(np.ceil((x1 + margin) * sfreq)) + 1, n_times)
+    if start >= stop: # range outside of the recording
+        return 0, n_times
+    return start, stop
+
+def decimate_minmax(times, data, n_px):
+    """
+    Reduce signal of shape (n_channels, n_times) to at most 2*n_px points per channel
+    Min and max of every pixel bucket are kept in time order, so the drawn trace looks the same
+    Returns times and data of shape (n_channels, n_points)
+    """
+    n_channels, n_times = data.shape
+    if n_px is None or n_times <= 2 * n_px:
+        return np.broadcast_to(times, data.shape), data
+
+    bucket = int(np.ceil(n_times / n_px))
+    n_buckets = n_times // bucket
+    full = n_buckets * bucket
+    buckets = data[:, :full].reshape(n_channels, n_buckets, bucket)
+    first = np.argmin(buckets, axis=2)
+    second = np.argmax(buckets, axis=2)
+    offsets = np.arange(n_buckets) * bucket
+    idx = np.stack([np.minimum(first, second), np.maximum(first, second)], axis=2) + offsets[None, :, None]
+    idx = idx.reshape(n_channels, -1)
+
+    # samples that don't fill the last bucket
+    if full < n_times:
+        tail = data[:, full:]
+        tail_idx = np.sort(np.stack([np.argmin(tail, axis=1), np.argmax(tail, axis=1)], axis=1), axis=1) + full
+        idx = np.concatenate([idx, tail_idx], axis=1)
+
+    return times[idx], np.take_along_axis(data, idx, axis=1)
 
 # Function to plot PSD for a channel across all bands
-def plot_channel_bands(raw, spectrum, channel_name, all_bands, band_names):
-    if channel_name not in raw.info['ch_names']:
+def plot_channel_bands(raw, spectrum, channel_name, all_bands, band_names, band_powers=None):
+    index = channel_index(raw.info['ch_names'], channel_name)
+    if index is None:
         raise ValueError(f"Channel '{channel_name}' not found in the data.")
     
-    channel_index = raw.info['ch_names'].index(channel_name)
+    if band_powers is None:
+        band_powers = compute_band_powers(spectrum)
     
     bands_plot_data = []
-    for band, band_name in zip(all_bands, band_names):
-        power, freqs = get_power_band(spectrum, band)
-        channel_power = power[channel_index]
+    for (power, freqs), band_name in zip(band_powers["bands"], band_names):
+        channel_power = power[index]
         bands_plot_data.append((band_name, freqs, channel_power))
         
     return bands_plot_data
 
+# Function to plot topographic maps of band power, all bands if band is None
+@instrument()
+def plot_band_topomaps(spectrum, band_powers, band=None):
+    band_indices = list(range(len(bands_names))) if band is None else [get_band_index(band)]
+    power = band_powers["power"][:, band_indices]
+    info = spectrum.info
+    # bad channels (marked by the quality stage) are left out of the interpolation
+    good = [i for i, ch in enumerate(info['ch_names']) if ch not in info['bads']]
+    if good and len(good) < len(info['ch_names']):
+        info, power = mne.pick_info(info, good), power[good]
+    values = 10 * np.log10(np.maximum(power, np.finfo(float).tiny)) # dB
+    titles = [f"{bands_names[i]} ({bands_freq[i][0]} - {bands_freq[i][1]} Hz)" for i in band_indices]
+    return plot_topomaps(info, values, titles)
+
 # Function to plot the PSD for all channels in a specific band
 def plot_power_band(power_bands, band_name, raw, channel_name="all"):
-    for i, name in enumerate(bands_names):
-        if band_name.lower() == name.lower():
-            band_index = i
-            break
-        
-    selected_power_band = power_bands[band_index]
+    selected_power_band = power_bands[get_band_index(band_name)]
     pow1, freq1 = selected_power_band
     
     band_plot_data = []
@@ -275,8 +747,7 @@ def plot_power_band(power_bands, band_name, raw, channel_name="all"):
         for i, ch_name in enumerate(raw.info['ch_names']):
             band_plot_data.append((ch_name, freq1, pow1[i]))
     else:
-        channel_index = raw.info['ch_names'].index(channel_name)
-        band_plot_data.append((channel_name, freq1, pow1[channel_index]))
+        band_plot_data.append((channel_name, freq1, pow1[channel_index(raw.info['ch_names'], channel_name)]))
         
     return band_plot_data
 
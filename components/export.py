@@ -0,0 +1,50 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from flask import Response
+
+csv_chunk_rows = 65536 # rows formatted at once when streaming CSV
+# format -> (label, file extension, mimetype)
+export_formats = {
+    "csv": ("CSV", "csv", "text/csv"),
+    "parquet": ("Parquet", "parquet", "application/vnd.apache.parquet"),
+    "arrow": ("Arrow IPC", "arrow", "application/vnd.apache.arrow.file"),
+    "npz": ("NumPy NPZ", "npz", "application/octet-stream"),
+}
+
+
+def iter_csv(columns, chunk_rows=csv_chunk_rows):
+    # CSV text of columns (dict of equally long arrays) in chunks of chunk_rows rows
+    n_rows = len(next(iter(columns.values()))) if columns else 0
+    yield ",".join(columns) + "\n"
+    for start in range(0, n_rows, chunk_rows):
+        chunk = pd.DataFrame({name: values[start:start + chunk_rows] for name, values in columns.items()})
+        yield chunk.to_csv(header=False, index=False)
+
+def write_columns(columns, fmt):
+    # Bytes of columns in a binary format
+    buffer = io.BytesIO()
+    if fmt == "npz":
+        np.savez(buffer, **columns)
+    else:
+        table = pa.table(columns)
+        if fmt == "parquet":
+            pq.write_table(table, buffer)
+        else:
+            with pa.ipc.new_file(buffer, table.schema) as writer:
+                writer.write_table(table)
+    return buffer.getvalue()
+
+def export_response(columns, name, fmt):
+    """
+    Flask response downloading columns as name.<extension>
+    CSV is streamed chunk by chunk, so the whole text is never held in memory
+    """
+    _, extension, mimetype = export_formats[fmt]
+    headers = {"Content-Disposition": f'attachment; filename="{name}.{extension}"'}
+    if fmt == "csv":
+        return Response(iter_csv(columns), mimetype=mimetype, headers=headers)
+    return Response(write_columns(columns, fmt), mimetype=mimetype, headers=headers)
@@ -1,81 +1,304 @@
 import base64
+from collections import OrderedDict
 import datetime
+import heapq
 import json
+import mne
+import numpy as np
 import os
+import sqlite3
 import threading
-from time import sleep
+from time import time
 import uuid
 
-pause_event = threading.Event() # define pause event
+
+class LRUCache:
+    """
+    Least recently used cache bounded by the total size of stored numpy arrays (or bytes/str)
+    Oldest entries are evicted once max_bytes is exceeded
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self.size -= sizeof(self._items.pop(key))
+            self._items[key] = value
+            self.size += sizeof(value)
+            while self.size > self.max_bytes and len(self._items) > 1:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= sizeof(evicted)
+
+
+def sizeof(value):
+    # size of numpy array, bytes or str stored in LRUCache
+    return value.nbytes if hasattr(value, "nbytes") else len(value)
+
+
+filter_cache = LRUCache(max_bytes=512 * 1024**2) # filtered channels, 512 MB
+
+# chunked uploads live in their own folder, client chosen ids can't name cache, session or metrics files
+upload_folder = "uploads"
+upload_extensions = (".csv", ".xls", ".edf", ".xdf") # types read_file understands
+max_upload_bytes = 2 * 1024**3
 
 
 def filter_data(raw, low_freq=None, high_freq=None):
     filtered_raw = raw.copy().filter(l_freq=low_freq, h_freq=high_freq)
     return filtered_raw
+
+def filter_channels(raw, channel_indices, upload_id, low_freq=None, high_freq=None):
+    """
+    Return filtered data of shape (len(channel_indices), n_times)
+    Every channel is filtered once per (upload, band) and kept in filter_cache
+    """
+    rows = {}
+    for idx in channel_indices:
+        cached = filter_cache.get((upload_id, low_freq, high_freq, idx))
+        if cached is not None:
+            rows[idx] = cached
+    # filter only channels which aren't cached
+    missing = [idx for idx in channel_indices if idx not in rows]
+    if missing:
+        data = raw.get_data(picks=missing)
+        filtered = mne.filter.filter_data(data, raw.info['sfreq'], l_freq=low_freq, h_freq=high_freq, copy=False)
+        for idx, row in zip(missing, filtered):
+            # own copy, a view would keep the whole batch alive and break the byte count
+            rows[idx] = row = row.copy()
+            filter_cache.put((upload_id, low_freq, high_freq, idx), row)
+    return np.stack([rows[idx] for idx in channel_indices])
   
+class TempFileManager:
+    """
+    Tracks temporary files in data/ with expiry time and total size quota
+    Records are persisted row by row in SQLite, so every worker and background job shares them
+    Scheduler thread keeps expiries in a heap and sleeps until the nearest one,
+    files over quota are evicted least recently used first
+    """
+    def __init__(self, folder="data", db_path="temp_files.db", lifetime=datetime.timedelta(hours=24),
+                 max_bytes=10 * 1024**3, rescan_interval=3600):
+        self.folder = folder
+        self.db_path = db_path
+        self.lifetime = lifetime
+        self.max_bytes = max_bytes
+        self.rescan_interval = rescan_interval # files tracked by other processes are picked up this often
+        self._conn = None
+        self._pid = None
+        self._thread_pid = None
+        self._reset()
+        # scheduler thread and its lock don't survive fork (gunicorn --preload)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._heap = [] # (expiry, file_name)
+        self._scheduled = {} # file_name -> expiry in heap
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+
+    def _db(self):
+        # one connection per process, sqlite connections don't survive fork
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS temp_files (name TEXT PRIMARY KEY, expiry REAL, size INTEGER, last_access REAL)"
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    def track(self, file_name, expiry=None):
+        # Add file or renew its expiry, expiry is unix time (default now + lifetime)
+        now = time()
+        if expiry is None:
+            expiry = now + self.lifetime.total_seconds()
+        file_path = os.path.join(self.folder, file_name)
+        size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+        with self._lock:
+            self._db().execute(
+                "INSERT INTO temp_files VALUES (?, ?, ?, ?) ON CONFLICT(name) DO UPDATE SET "
+                "expiry = excluded.expiry, size = excluded.size, last_access = excluded.last_access",
+                (file_name, expiry, size, now),
+            )
+            self._schedule(file_name, expiry)
+            self._enforce_quota(keep=file_name)
+
+    def untrack(self, file_name):
+        # Forget file without removing it, e.g. after it was renamed
+        with self._lock:
+            self._db().execute("DELETE FROM temp_files WHERE name = ?", (file_name,))
+
+    def start(self):
+        # one scheduler thread per process
+        if self._thread_pid == os.getpid():
+            return
+        self._thread_pid = os.getpid()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _schedule(self, file_name, expiry):
+        # later expiry of already scheduled file is checked when the earlier one pops
+        if file_name in self._scheduled and self._scheduled[file_name] <= expiry:
+            return
+        self._scheduled[file_name] = expiry
+        heapq.heappush(self._heap, (expiry, file_name))
+        if self._heap[0][1] == file_name:
+            self._wakeup.notify()
+
+    def _load(self):
+        for file_name, expiry in self._db().execute("SELECT name, expiry FROM temp_files"):
+            self._schedule(file_name, expiry)
+
+    def _run(self):
+        with self._lock:
+            next_scan = 0
+            while True:
+                now = time()
+                if now >= next_scan:
+                    self._load()
+                    next_scan = now + self.rescan_interval
+                while self._heap and self._heap[0][0] <= now:
+                    _, file_name = heapq.heappop(self._heap)
+                    self._scheduled.pop(file_name, None)
+                    self._expire(file_name, now)
+                timeout = next_scan - now
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+                self._wakeup.wait(timeout=max(timeout, 0))
+
+    def _expire(self, file_name, now):
+        # database is the source of truth, other processes might have renewed the file
+        row = self._db().execute("SELECT expiry FROM temp_files WHERE name = ?", (file_name,)).fetchone()
+        if row is None:
+            return
+        if row[0] > now:
+            self._schedule(file_name, row[0])
+            return
+        self._remove(file_name)
+
+    def _enforce_quota(self, keep=None):
+        total = self._db().execute("SELECT COALESCE(SUM(size), 0) FROM temp_files").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db().execute("SELECT name, size FROM temp_files ORDER BY last_access").fetchall()
+        for file_name, size in rows:
+            if total <= self.max_bytes:
+                break
+            if file_name != keep:
+                self._remove(file_name)
+                total -= size
+
+    def _remove(self, file_name):
+        file_path = os.path.join(self.folder, file_name)
+        if os.path.exists(file_path):
+            print(f"Removing {file_name}")
+            os.remove(file_path)
+        self._db().execute("DELETE FROM temp_files WHERE name = ?", (file_name,))
+
+
+temp_files = TempFileManager()
+
+
 def initialize():
-    os.makedirs("data", exist_ok=True)
-    with open("temp_files.json", "w") as f:
-        json.dump({}, f, indent=4)
+    os.makedirs(os.path.join("data", upload_folder), exist_ok=True)
+    # move records of the old temp_files.json tracker
+    if os.path.exists("temp_files.json"):
+        with open("temp_files.json", "r") as f:
+            for file_name, expiry in json.load(f).items():
+                temp_files.track(file_name, datetime.datetime.fromisoformat(expiry).timestamp())
+        os.remove("temp_files.json")
    
 def start_data_thread():
-    threading.Thread(target=cleanup_expired_files, daemon=True).start()
-
-def cleanup_expired_files():
-    last_time = datetime.datetime.min # intialize last_time
-    if_changed = False
-    pause_event.wait() # instruct to wait until the flag is set
-    while True:
-        now = datetime.datetime.now()
-        if now > last_time:
-            with open("temp_files.json", "r") as f:
-                file_tracker = json.load(f)
-            print("Checking temp_files...")
-            # check if file expires
-            for file, expiry in list(file_tracker.items()):
-                file_path = os.path.join("data", file)
-                if now > datetime.datetime.fromisoformat(expiry) and os.path.exists(file_path):
-                    print(f"Removing {file}")
-                    os.remove(file_path)
-                    del file_tracker[file]
-                    if_changed = True
-            # save changes
-            if if_changed:
-                with open("temp_files.json", "w") as f:
-                    json.dump(file_tracker, f)
-                    if_changed = False
-                # check hour later
-                print("Temp_files removed")
-            last_time = datetime.datetime.now() + datetime.timedelta(hours=24)
+    temp_files.start()
 
 def create_file(content, file_type):
-    pause_event.clear() # block data thread
     # create temporary file stored in data
-    if file_type != ".png":
-        data = content.encode("utf8").split(b";base64,")[1]
-        file_name = f"{uuid.uuid4()}.{file_type}"
-        save_path = os.path.join("data", file_name)
-        with open(save_path, "wb") as fp:
-            fp.write(base64.decodebytes(data))
-    elif file_type == ".png":
-        file_name = f"{uuid.uuid4()}.{file_type}"
-        save_path = os.path.join("data", file_name)
-        content.savefig(save_path, bbox_inches="tight")
-    else:
-        raise TypeError
-
-    # read temp_files.json
-    with open("temp_files.json", "r") as f:
-        file = json.load(f)
-    # set cooldown for a temp file
-    file[file_name] = (datetime.datetime.now() + datetime.timedelta(hours=24)).isoformat()
-
-    # write json
-    print(f"Adding {file_name} to temp_files")
-    with open("temp_files.json", "w") as f:
-        json.dump(file, f)
-    
-    sleep(1) # ensure record has been written
-    pause_event.set() # resume thread
+    file_name = f"{uuid.uuid4()}.{file_type}"
+    save_path = os.path.join("data", file_name)
+    decode_to_file(content, save_path)
+
+    track_file(file_name)
     return save_path
 
+def decode_to_file(content, save_path, chunk_chars=4 * 1024**2):
+    """
+    Decode base64 data URL into a file slice by slice
+    Whole decoded bytes are never held in memory next to the string
+    """
+    start = content.index(";base64,") + len(";base64,")
+    with open(save_path, "wb") as fp:
+        # slices are multiples of 4 characters so every one decodes on its own
+        for pos in range(start, len(content), chunk_chars):
+            fp.write(base64.b64decode(content[pos:pos + chunk_chars]))
+
+def track_file(file_name):
+    # set cooldown for a temp file, tracking again renews it
+    temp_files.track(file_name)
+
+def untrack_file(file_name):
+    # stop tracking a temp file which was renamed into the cache
+    temp_files.untrack(file_name)
+
+def is_valid_id(file_id):
+    # upload and session ids are 32 hex characters, anything else can't become part of a path
+    return isinstance(file_id, str) and len(file_id) == 32 and all(char in "0123456789abcdef" for char in file_id)
+
+def append_chunk(upload_id, offset, stream, block_size=1024**2):
+    """
+    Append chunk of a resumable upload to data/uploads/<upload_id>.part
+    Chunk is written only if offset matches already received size
+    Raises ValueError if the upload would grow over max_upload_bytes, the partial file is then removed
+    Returns size of the partial file and whether chunk was accepted
+    """
+    part_name = os.path.join(upload_folder, f"{upload_id}.part")
+    part_path = os.path.join("data", part_name)
+    size = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if offset != size:
+        return size, False
+    with open(part_path, "ab") as fp:
+        while True:
+            block = stream.read(block_size)
+            if not block:
+                break
+            size += len(block)
+            if size > max_upload_bytes:
+                break
+            fp.write(block)
+    if size > max_upload_bytes:
+        os.remove(part_path)
+        track_file(part_name) # record drops to size 0 and expires
+        raise ValueError(f"Upload is larger than {max_upload_bytes // 1024**2} MB")
+    track_file(part_name) # tracked with its current size, so the quota counts partial uploads
+    return size, True
+
+def upload_path(upload_id, file_name):
+    # Finished chunked uploads are stored as data/uploads/<upload_id>.<extension>, apart from cached data
+    if not is_valid_id(upload_id):
+        raise ValueError(f"Invalid upload id: {upload_id}")
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in upload_extensions:
+        raise ValueError(f"Unsupported file type: {extension}")
+    return os.path.join("data", upload_folder, f"{upload_id}{extension}")
+
+def complete_upload(upload_id, file_name):
+    # Rename finished partial upload to its final name, only readable file types are accepted
+    save_path = upload_path(upload_id, file_name)
+    part_path = os.path.join("data", upload_folder, f"{upload_id}.part")
+    if not os.path.exists(part_path):
+        raise FileNotFoundError(part_path)
+    os.replace(part_path, save_path)
+    track_file(os.path.relpath(save_path, "data"))
+    return save_path
@@ -1,5 +1,8 @@
 from dash import dcc, html
 
+from components.data_acc import connectivity_measures
+from components.export import export_formats
+
 number_of_channels = 0  
 
 def create_header():
@@ -18,6 +21,16 @@ def create_upload_section():
         children=html.Div(["Drag and Drop or ", html.A("Select Files")]),
     )
 
+def create_upload_progress():
+    return html.Div(
+        [
+            html.Label(id="upload-progress-label"),
+            html.Progress(id="upload-progress", value="0", max="1"),
+        ],
+        id="upload-progress-container",
+        style={"display": "none"},
+    )
+
 def create_channel_assignment_row(channel_number, channels_names, value=None):
     return html.Div(
         [
@@ -109,8 +122,85 @@ def create_channel_name_assignment():
         style={"display": "none"},
     )
 
-def create_main_visualization_container(mne_raw, bands_names):
-    from app import assigned_channels_names  # Import the global list
+def create_live_section():
+    # Replays the uploaded recording at real-time rate, new samples are appended to the plot
+    return html.Div(
+        [
+            html.H2("Live Mode"),
+            html.Button("Start Live Replay", id="live-start-button", n_clicks=0, style={"margin-right": "10px"}),
+            html.Button("Stop", id="live-stop-button", n_clicks=0),
+            dcc.Graph(id="live-plot"),
+            dcc.Graph(id="live-band-plot"),
+            dcc.Interval(id="live-interval", interval=250, disabled=True),
+            dcc.Store(id="live-cursor"),
+        ],
+        id="live-container",
+    )
+
+def create_export_controls(format_id, link_id, button):
+    # Format selection and link to the streamed export, href is set by a callback
+    return html.Div(
+        [
+            dcc.Dropdown(
+                id=format_id,
+                options=[{"label": export_formats[fmt][0], "value": fmt} for fmt in export_formats],
+                value="csv",
+                clearable=False,
+                style={"width": "200px"},
+            ),
+            html.A(button, id=link_id, download=""),
+        ],
+        className="export-controls",
+    )
+
+def create_cohort_section():
+    # Batch of recordings processed together, band power table of all subjects and cohort topomaps
+    return html.Div(
+        [
+            html.H2("Cohort"),
+            dcc.Upload(
+                id="cohort-upload-zone",
+                multiple=True,
+                children=html.Div(["Drag and Drop or ", html.A("Select Files"), " of all subjects"]),
+            ),
+            html.Div(
+                [
+                    html.Label(id="cohort-progress-label"),
+                    html.Progress(id="cohort-progress", value="0", max="1"),
+                ],
+                id="cohort-progress-container",
+                style={"display": "none"},
+            ),
+            html.Div(id="cohort-failed"), # files left out of the statistics
+            dcc.RadioItems(
+                id="cohort-statistic",
+                options=[
+                    {"label": "Mean", "value": "mean"},
+                    {"label": "Standard Deviation", "value": "sd"},
+                ],
+                value="mean",
+                inline=True,
+            ),
+            dcc.Graph(id="cohort-plot"),
+            create_export_controls("cohort-export-format", "cohort-export-link", html.Button("Export Band Powers", id="cohort-export-button")),
+            dcc.Store(id="cohort-files"), # set by assets/chunked_upload.js
+            dcc.Store(id="cohort-result"),
+        ],
+        id="cohort-container",
+    )
+
+def create_metrics_panel():
+    # Debug panel with callback and stage timings, only shown with BRAINUP_DEBUG_PANEL=1
+    return html.Div(
+        [
+            html.H2("Metrics"),
+            html.Table(id="metrics-table"),
+            dcc.Interval(id="metrics-interval", interval=5000),
+        ],
+        id="metrics-panel",
+    )
+
+def create_main_visualization_container(bands_names):
     return html.Div(
         [
             dcc.RadioItems(
@@ -119,6 +209,8 @@ def create_main_visualization_container(mne_raw, bands_names):
                     {"label": "Raw Signal", "value": "raw"},
                     {"label": "PSD for Specific Band", "value": "specific_band"},
                     {"label": "Topo", "value":"topo"},
+                    {"label": "Band Power over Time", "value": "band_time"},
+                    {"label": "Connectivity", "value": "connectivity"},
                 ],
                 value="raw",
                 inline=True,
@@ -126,8 +218,7 @@ def create_main_visualization_container(mne_raw, bands_names):
             html.Label("Select Channel:"),
             dcc.Dropdown(
                 id="channel-dropdown",
-                options=[{"label": "All Channels", "value": "all"}] +
-                        [{"label": ch, "value": ch} for ch in assigned_channels_names],
+                options=[{"label": "All Channels", "value": "all"}],
                 value=None,
             ),
             html.Div(
@@ -150,6 +241,34 @@ def create_main_visualization_container(mne_raw, bands_names):
                 id="band-dropdown-container",
                 style={"display": "none"},
             ),
+            html.Div(
+                [
+                    html.Label("Window Length:"),
+                    dcc.Slider(
+                        id="window-length-slider",
+                        min=2,
+                        max=60,
+                        step=1,
+                        marks={i: f"{i} s" for i in [2, 10, 20, 30, 40, 50, 60]},
+                        value=10,
+                    ),
+                ],
+                id="window-length-container",
+                style={"display": "none"},
+            ),
+            html.Div(
+                [
+                    html.Label("Connectivity Measure:"),
+                    dcc.RadioItems(
+                        id="connectivity-measure",
+                        options=[{"label": label, "value": measure} for measure, label in connectivity_measures.items()],
+                        value="coherence",
+                        inline=True,
+                    ),
+                ],
+                id="connectivity-measure-container",
+                style={"display": "none"},
+            ),
             html.Br(),
             html.Div(
                 [
@@ -184,26 +303,31 @@ def create_main_visualization_container(mne_raw, bands_names):
                 id="filter-selection-container",
             ),
             dcc.Graph(id="eeg-plot"),
-            html.Button("Download Power Band", id="download-button"),
-            dcc.Download(id="download-dataframe-csv"),
-          
-            html.Img(id="topo-img", style={"display": "none"}),
+            create_export_controls("download-format", "download-link", html.Button("Download Power Band", id="download-button")),
+            create_live_section(),
+
         ],
         id="main-container",
         style={"display": "none"},
     )
 
-def create_viz_data_layout(mne_raw, bands_names, number_of_channels):
+def create_viz_data_layout(bands_names, number_of_channels):
     return html.Div([
         dcc.Store(id="name-channels", data=False),
         dcc.Store(id="number-of-channels", data=number_of_channels),
         dcc.Store(id="electrode-view-store", data={"type": "21_electrodes"}),  
-        dcc.Store(id="channels-names-store", data=[]),  # <-- Add this line
+        dcc.Store(id="uploaded-file"), # set by assets/chunked_upload.js
+        dcc.Store(id="upload-partial"), # result of the last finished upload stage
+        dcc.Store(id="upload-stage"), # result of the whole upload processing
+        dcc.Store(id="active-upload"),
+        dcc.Store(id="plot-state"), # what eeg-plot shows, lets update_plot patch the figure
         create_header(),
         create_upload_section(),
+        create_upload_progress(),
         html.Br(),
         html.Br(),
 
         create_channel_name_assignment(),
-        create_main_visualization_container(mne_raw, bands_names),
+        create_main_visualization_container(bands_names),
+        create_cohort_section(),
     ])
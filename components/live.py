@@ -0,0 +1,254 @@
+import json
+import os
+import threading
+from time import monotonic, time
+import uuid
+
+import numpy as np
+
+from components.data_acc import bands_freq, data_folder, decimate_minmax, plot_width_px, segment_band_powers, segment_seconds
+from components.helpers import is_valid_id, track_file
+
+live_seconds = 30 # seconds of signal kept for the live plot
+live_window = 10 # seconds of segments averaged for live band power
+chunk_seconds = 0.1 # replayer pushes samples in chunks of this length
+guard_seconds = 1.0 # oldest samples readers skip, the writer may be overwriting them
+idle_seconds = 60 # replay stops when nobody polled it for this long
+# int64 header of a shared live buffer file, followed by samples and segment band powers (float32)
+header_fields = ("count", "segments", "last_poll", "stopped")
+
+
+class RingBuffer:
+    """
+    Fixed-size buffer of the latest samples of every channel (n_channels, capacity)
+    count is the number of samples ever written, so readers can ask for samples after their last count
+    data and counter can be views of a shared memory-mapped file, then readers in other processes
+    see what one writer appends (count is updated after the samples, the oldest guard samples aren't read)
+    """
+    def __init__(self, n_channels, capacity, dtype=np.float32, data=None, counter=None, guard=0):
+        self.capacity = capacity
+        self.guard = min(guard, capacity - 1)
+        self._data = np.zeros((n_channels, capacity), dtype=dtype) if data is None else data
+        self._counter = np.zeros(1, dtype=np.int64) if counter is None else counter
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return int(self._counter[0])
+
+    def append(self, chunk):
+        # chunk (n_channels, n_samples), only the last capacity samples are kept
+        skipped = max(0, chunk.shape[1] - self.capacity)
+        chunk = chunk[:, skipped:]
+        n = chunk.shape[1]
+        with self._lock:
+            count = self.count
+            pos = (count + skipped) % self.capacity
+            first = min(n, self.capacity - pos)
+            self._data[:, pos:pos + first] = chunk[:, :first]
+            self._data[:, :n - first] = chunk[:, first:]
+            self._counter[0] = count + skipped + n
+
+    def since(self, count):
+        # Returns copy of samples written after count (oldest ones if they were overwritten) and index of the first one
+        with self._lock:
+            end = self.count
+            start = min(max(count, end - self.capacity + self.guard, 0), end)
+            data = self._data[:, np.arange(start, end) % self.capacity]
+            # writer in another process may have wrapped around while samples were copied
+            overwritten = min(max(0, self.count - self.capacity + self.guard - start), end - start)
+            return data[:, overwritten:], start + overwritten
+
+    def latest(self, n):
+        return self.since(self.count - n)[0]
+
+
+class LiveStream:
+    """
+    Samples of a running recording in a ring buffer, fed by push(chunk) from any source
+    Band power is updated per chunk: only Welch segments completed by the new samples are transformed
+    and their band powers go to a second ring buffer
+    With path both buffers live in a memory-mapped file, so every worker can read a stream one process feeds
+    """
+    def __init__(self, sfreq, ch_names, buffer_seconds=live_seconds, seg_seconds=segment_seconds, path=None, create=False):
+        self.sfreq = sfreq
+        self.ch_names = list(ch_names)
+        self.seg_seconds = seg_seconds
+        self.path = path
+        self.nperseg = max(2, int(round(seg_seconds * sfreq)))
+        self.step = self.nperseg // 2
+        capacity = int(buffer_seconds * sfreq)
+        n_rows, seg_capacity = len(ch_names) * len(bands_freq), int(buffer_seconds / (self.step / sfreq)) + 1
+        samples = segments = None
+        if path is None:
+            self.header = np.zeros(len(header_fields), dtype=np.int64)
+        else:
+            header_bytes = 8 * len(header_fields)
+            samples_bytes = 4 * len(ch_names) * capacity
+            if create:
+                with open(path, "wb") as f:
+                    f.truncate(header_bytes + samples_bytes + 4 * n_rows * seg_capacity)
+            self.header = np.memmap(path, dtype=np.int64, mode="r+", shape=(len(header_fields),))
+            samples = np.memmap(path, dtype=np.float32, mode="r+", offset=header_bytes, shape=(len(ch_names), capacity))
+            segments = np.memmap(path, dtype=np.float32, mode="r+", offset=header_bytes + samples_bytes, shape=(n_rows, seg_capacity))
+        fields = {name: self.header[i:i + 1] for i, name in enumerate(header_fields)}
+        self.buffer = RingBuffer(len(ch_names), capacity, data=samples, counter=fields["count"], guard=int(guard_seconds * sfreq))
+        self.segments = RingBuffer(n_rows, seg_capacity, data=segments, counter=fields["segments"])
+        self.next_segment = 0 # first sample of the next segment
+
+    def touch(self):
+        # Mark the stream as watched, see Replayer idle timeout
+        self.header[header_fields.index("last_poll")] = int(time() * 1000)
+
+    def seconds_since_poll(self):
+        return time() - self.header[header_fields.index("last_poll")] / 1000
+
+    def stop(self):
+        # Ask the process feeding the stream to stop, works from any process
+        self.header[header_fields.index("stopped")] = 1
+
+    @property
+    def stopped(self):
+        return bool(self.header[header_fields.index("stopped")])
+
+    def push(self, chunk):
+        self.buffer.append(np.asarray(chunk, dtype=np.float32))
+        if self.buffer.count - self.next_segment < self.nperseg:
+            return
+        data, start = self.buffer.since(self.next_segment)
+        powers, _, _ = segment_band_powers(data, self.sfreq, self.seg_seconds) # (n_channels, n_segments, n_bands)
+        n_segments = powers.shape[1]
+        self.segments.append(powers.transpose(0, 2, 1).reshape(-1, n_segments))
+        self.next_segment = start + n_segments * self.step
+
+    def band_power(self, window_seconds=live_window):
+        # Mean band power (n_channels, n_bands) of segments in the last window_seconds, None before the first segment
+        n = max(1, int(round(window_seconds / (self.step / self.sfreq))))
+        powers = self.segments.latest(n)
+        if powers.shape[1] == 0:
+            return None
+        return powers.mean(axis=1).reshape(len(self.ch_names), len(bands_freq))
+
+
+class Replayer(threading.Thread):
+    """
+    Stand-in for a live source: pushes a recording (n_channels, n_times) to stream at real-time rate
+    Starts over at the end of the recording if loop is set
+    Stops when the stream is stopped (by any process) or nobody polled it for idle_seconds,
+    on_exit is called when it ends
+    """
+    def __init__(self, stream, data, loop=True, on_exit=None):
+        super().__init__(daemon=True)
+        self.stream = stream
+        self.data = data
+        self.loop = loop
+        self.on_exit = on_exit
+        self._stop_event = threading.Event()
+
+    def run(self):
+        n = max(1, int(round(chunk_seconds * self.stream.sfreq)))
+        position = 0
+        deadline = monotonic()
+        while not self._stop_event.is_set() and not self.stream.stopped and self.stream.seconds_since_poll() < idle_seconds:
+            if position >= self.data.shape[1]:
+                if not self.loop:
+                    break
+                position = 0
+            chunk = self.data[:, position:position + n]
+            self.stream.push(chunk)
+            position += chunk.shape[1]
+            # sleep until the pushed samples would have been recorded
+            deadline += chunk.shape[1] / self.stream.sfreq
+            self._stop_event.wait(max(0, deadline - monotonic()))
+        if self.on_exit is not None:
+            self.on_exit()
+
+    def stop(self):
+        self._stop_event.set()
+
+
+def read_new_samples(stream, channel_indices, count, n_px=plot_width_px):
+    """
+    Samples of the given channels that arrived after count, for extending the live plot
+    They are decimated so the whole live plot holds about n_px min/max pairs
+    Returns times (n_channels, n_points), data and the new count
+    """
+    data, start = stream.buffer.since(count)
+    n_samples = data.shape[1]
+    times = (start + np.arange(n_samples)) / stream.sfreq
+    bucket_px = max(1, int(n_px * n_samples / stream.buffer.capacity))
+    times, data = decimate_minmax(times, data[channel_indices], bucket_px)
+    return times, data, start + n_samples
+
+
+def live_path(session_id):
+    # data/live_<session_id>.json names the buffer file of the current replay of a session
+    if not is_valid_id(session_id):
+        raise ValueError(f"Invalid session id: {session_id}")
+    return os.path.join(data_folder, f"live_{session_id}.json")
+
+def read_live_state(session_id):
+    try:
+        with open(live_path(session_id), "r") as f:
+            return json.load(f)
+    except (ValueError, FileNotFoundError):
+        return None
+
+# streams opened by this process by session id, the replay itself runs in the worker that started it
+live_streams = {}
+live_lock = threading.Lock()
+
+def start_replay(session_id, data, sfreq, ch_names):
+    """
+    Replace the live stream of the session with a replay of data
+    Samples go to data/live_<session_id>_<replay id>.buf, the session's live state points workers to it
+    """
+    stop_replay(session_id)
+    buffer_name = f"live_{session_id}_{uuid.uuid4().hex}.buf"
+    stream = LiveStream(sfreq, ch_names, path=os.path.join(data_folder, buffer_name), create=True)
+    stream.touch()
+    track_file(buffer_name) # left behind by a crashed worker it expires like other temp files
+
+    def remove_buffer():
+        # readers that still map the buffer keep their view, new ones see the replay ended
+        if os.path.exists(stream.path):
+            os.remove(stream.path)
+        state = read_live_state(session_id)
+        if state is not None and state["buffer"] == buffer_name:
+            os.remove(live_path(session_id))
+
+    file_path = live_path(session_id)
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"buffer": buffer_name, "sfreq": sfreq, "ch_names": list(ch_names)}, f)
+    os.replace(tmp_path, file_path)
+    track_file(os.path.basename(file_path))
+    with live_lock:
+        live_streams[session_id] = (buffer_name, stream)
+    Replayer(stream, data, on_exit=remove_buffer).start()
+    return stream
+
+def stop_replay(session_id):
+    # Stop the replay of the session in whichever worker runs it
+    stream = get_stream(session_id)
+    if stream is not None:
+        stream.stop()
+    with live_lock:
+        live_streams.pop(session_id, None)
+
+def get_stream(session_id):
+    # Live stream of the session opened from its shared buffer or None if no replay runs
+    state = read_live_state(session_id)
+    with live_lock:
+        entry = live_streams.get(session_id)
+        if state is None:
+            live_streams.pop(session_id, None)
+            return None
+        if entry is not None and entry[0] == state["buffer"]:
+            return entry[1]
+        try:
+            stream = LiveStream(state["sfreq"], state["ch_names"], path=os.path.join(data_folder, state["buffer"]))
+        except FileNotFoundError: # replay ended meanwhile
+            return None
+        live_streams[session_id] = (state["buffer"], stream)
+        return stream
@@ -0,0 +1,316 @@
+from contextlib import contextmanager
+import fcntl
+from functools import wraps
+import json
+import os
+import threading
+from time import perf_counter, thread_time, time
+import tracemalloc
+import uuid
+
+from flask import Response, g, request
+
+# BRAINUP_METRICS=0 turns recording off, BRAINUP_TRACEMALLOC=1 adds peak allocation (slows allocations down)
+metrics_enabled = os.environ.get("BRAINUP_METRICS", "1") != "0"
+debug_panel_enabled = os.environ.get("BRAINUP_DEBUG_PANEL", "0") == "1"
+if os.environ.get("BRAINUP_TRACEMALLOC", "0") == "1" and not tracemalloc.is_tracing():
+    tracemalloc.start()
+
+buckets = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60] # wall time histogram bounds in seconds
+snapshot_interval = 10 # seconds between snapshots of this process written for other processes
+total_file = "metrics_total.json" # numbers of processes that ended, never expires so counters don't go down
+
+
+class Metrics:
+    """
+    Wall time, CPU time, response bytes and peak allocation aggregated by (kind, name)
+    kind is "callback" for Dash callback requests and "stage" for instrumented functions and stages
+    Every running process (gunicorn worker, background job) keeps its own numbers and writes
+    a snapshot to data/metrics_<pid>.json at most every snapshot_interval seconds
+    Processes that end (jobs, pool processes, exiting workers) merge their numbers into
+    data/metrics_total.json, snapshots of processes that died without merging are merged by collect,
+    /metrics adds up the total and snapshots of running processes
+    """
+    def __init__(self, folder="data"):
+        self.folder = folder
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._file_lock = threading.Lock() # snapshot isn't written while it's being merged
+        self._saved = 0
+        self._pid = os.getpid()
+
+    def record(self, kind, name, wall, cpu, n_bytes=None, peak=None):
+        with self._lock:
+            # forked process (background job) starts without numbers of its parent
+            if self._pid != os.getpid():
+                self._entries, self._pid = {}, os.getpid()
+            entry = self._entries.get((kind, name))
+            if entry is None:
+                entry = self._entries[(kind, name)] = {"count": 0, "wall": 0.0, "cpu": 0.0, "bytes": 0, "peak": 0, "buckets": [0] * (len(buckets) + 1)}
+            entry["count"] += 1
+            entry["wall"] += wall
+            entry["cpu"] += cpu
+            entry["bytes"] += n_bytes or 0
+            entry["peak"] = max(entry["peak"], peak or 0)
+            entry["buckets"][next((i for i, bound in enumerate(buckets) if wall <= bound), len(buckets))] += 1
+            save = time() - self._saved >= snapshot_interval
+        if save:
+            self.save()
+
+    def snapshot(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                return {}
+            return {f"{kind}\t{name}": dict(entry, buckets=list(entry["buckets"])) for (kind, name), entry in self._entries.items()}
+
+    def save(self):
+        # snapshot of this process for /metrics served by other processes, removed by merge (not expired)
+        self._saved = time()
+        path = os.path.join(self.folder, f"metrics_{os.getpid()}.json")
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with self._file_lock:
+            try:
+                with open(tmp_path, "w") as f:
+                    json.dump(self.snapshot(), f)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                print(f"Error saving metrics: {e}")
+
+    def merge(self):
+        """
+        Add numbers of this process to the persistent total and start over from zero
+        Called by processes that end (or finish a unit of work in a pool), their snapshot is removed
+        """
+        with self._file_lock:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._entries, self._pid = {}, os.getpid()
+                own = {f"{kind}\t{name}": entry for (kind, name), entry in self._entries.items()}
+                self._entries = {}
+            try:
+                with self._total_lock():
+                    self._write_total(add_entries(self._read(total_file) or {}, own))
+                    self._remove_snapshot(os.getpid())
+            except OSError as e:
+                print(f"Error merging metrics: {e}")
+
+    def collect(self):
+        """
+        Entries of all processes added up, this process is taken from memory
+        Snapshots of processes that are gone are merged into the total on the way
+        """
+        snapshots = {}
+        for file_name in os.listdir(self.folder):
+            pid = snapshot_pid(file_name)
+            if pid is not None and pid != os.getpid():
+                snapshots[pid] = self._read(file_name)
+        dead = [pid for pid in snapshots if not is_running(pid)]
+        if dead:
+            with self._total_lock():
+                total = self._read(total_file) or {}
+                for pid in dead:
+                    # read again under the lock, another process may have merged it already
+                    snapshot = self._read(f"metrics_{pid}.json")
+                    if snapshot:
+                        total = add_entries(total, snapshot)
+                    self._remove_snapshot(pid)
+                    snapshots.pop(pid)
+                self._write_total(total)
+        total = self._read(total_file) or {}
+        for snapshot in [self.snapshot()] + [snapshot for snapshot in snapshots.values() if snapshot]:
+            total = add_entries(total, snapshot)
+        return {tuple(key.split("\t", 1)): entry for key, entry in total.items()}
+
+    def _read(self, file_name):
+        try:
+            with open(os.path.join(self.folder, file_name), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_total(self, total):
+        path = os.path.join(self.folder, total_file)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(total, f)
+        os.replace(tmp_path, path)
+
+    def _remove_snapshot(self, pid):
+        path = os.path.join(self.folder, f"metrics_{pid}.json")
+        if os.path.exists(path):
+            os.remove(path)
+
+    @contextmanager
+    def _total_lock(self):
+        # merges of all processes are serialized, so no snapshot is counted twice
+        with open(os.path.join(self.folder, "metrics_total.lock"), "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def add_entries(total, snapshot):
+    # Sum of two {"kind\tname": entry} dicts, peak is the maximum
+    total = {key: dict(entry, buckets=list(entry["buckets"])) for key, entry in total.items()}
+    for key, entry in snapshot.items():
+        if key not in total:
+            total[key] = dict(entry, buckets=list(entry["buckets"]))
+            continue
+        merged = total[key]
+        for field in ("count", "wall", "cpu", "bytes"):
+            merged[field] += entry[field]
+        merged["peak"] = max(merged["peak"], entry["peak"])
+        merged["buckets"] = [a + b for a, b in zip(merged["buckets"], entry["buckets"])]
+    return total
+
+def snapshot_pid(file_name):
+    # pid of a data/metrics_<pid>.json snapshot, None for other files
+    name, extension = os.path.splitext(file_name)
+    if extension != ".json" or not name.startswith("metrics_") or not name[len("metrics_"):].isdigit():
+        return None
+    return int(name[len("metrics_"):])
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+metrics = Metrics()
+
+
+class Measurement:
+    """
+    Wall time, CPU time of the current thread and peak traced allocation of a block
+    Nested measurements pass their peak to the outer one, tracemalloc peak is shared
+    by all threads so it's approximate under concurrency
+    """
+    _local = threading.local()
+
+    def start(self):
+        self.peak = 0
+        if tracemalloc.is_tracing():
+            self.base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.parent = getattr(self._local, "current", None)
+        self._local.current = self
+        self.wall = perf_counter()
+        self.cpu = thread_time()
+        return self
+
+    def stop(self):
+        self.wall = perf_counter() - self.wall
+        self.cpu = thread_time() - self.cpu
+        self._local.current = self.parent
+        if tracemalloc.is_tracing():
+            absolute = max(tracemalloc.get_traced_memory()[1], self.peak)
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, absolute)
+            self.peak = absolute - self.base
+        return self
+
+
+@contextmanager
+def stage(name):
+    # Record a block (e.g. pipeline stage) as stage metric
+    if not metrics_enabled:
+        yield
+        return
+    measurement = Measurement().start()
+    try:
+        yield
+    finally:
+        measurement.stop()
+        metrics.record("stage", name, measurement.wall, measurement.cpu, peak=measurement.peak)
+
+def instrument(name=None):
+    # Decorator recording every call of a function as stage metric
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def callback_name(app, payload):
+    # Name of the callback function handling /_dash-update-component request
+    output = payload.get("output") if isinstance(payload, dict) else None
+    callback = app.callback_map.get(output, {}).get("callback")
+    return getattr(callback, "__name__", output or "unknown")
+
+def register_metrics(app):
+    """
+    Measure every Dash callback request (wall and CPU time, response bytes, peak allocation)
+    and serve all metrics at /metrics in Prometheus text format
+    """
+    server = app.server
+
+    @server.before_request
+    def start_measurement():
+        # polls of running background callbacks (cacheKey) aren't calls of the callback
+        if metrics_enabled and request.path.endswith("/_dash-update-component") and not request.args.get("cacheKey"):
+            g.measurement = Measurement().start()
+
+    @server.after_request
+    def record_measurement(response):
+        measurement = g.pop("measurement", None)
+        if measurement is not None:
+            measurement.stop()
+            n_bytes = response.calculate_content_length() or 0
+            name = callback_name(app, request.get_json(silent=True))
+            metrics.record("callback", name, measurement.wall, measurement.cpu, n_bytes, measurement.peak)
+        return response
+
+    @server.route("/metrics")
+    def metrics_endpoint():
+        return Response(prometheus_text(metrics.collect()), mimetype="text/plain; version=0.0.4")
+
+def prometheus_text(entries):
+    lines = []
+    for kind, description in (("callback", "Dash callback requests"), ("stage", "instrumented stages")):
+        selected = sorted((name, entry) for (k, name), entry in entries.items() if k == kind)
+        prefix = f"brainup_{kind}"
+        lines += [f"# HELP {prefix}_seconds Wall time of {description}", f"# TYPE {prefix}_seconds histogram"]
+        for name, entry in selected:
+            label = escape_label(name)
+            cumulative = 0
+            for bound, count in zip(buckets + ["+Inf"], entry["buckets"]):
+                cumulative += count
+                lines.append(f'{prefix}_seconds_bucket{{name="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_seconds_sum{{name="{label}"}} {entry["wall"]}')
+            lines.append(f'{prefix}_seconds_count{{name="{label}"}} {entry["count"]}')
+        lines += [f"# HELP {prefix}_cpu_seconds_total CPU time of {description}", f"# TYPE {prefix}_cpu_seconds_total counter"]
+        lines += [f'{prefix}_cpu_seconds_total{{name="{escape_label(name)}"}} {entry["cpu"]}' for name, entry in selected]
+        if kind == "callback":
+            lines += [f"# HELP {prefix}_response_bytes_total Bytes of serialized responses", f"# TYPE {prefix}_response_bytes_total counter"]
+            lines += [f'{prefix}_response_bytes_total{{name="{escape_label(name)}"}} {entry["bytes"]}' for name, entry in selected]
+        if tracemalloc.is_tracing():
+            lines += [f"# HELP {prefix}_peak_alloc_bytes Highest peak of traced allocations", f"# TYPE {prefix}_peak_alloc_bytes gauge"]
+            lines += [f'{prefix}_peak_alloc_bytes{{name="{escape_label(name)}"}} {entry["peak"]}' for name, entry in selected]
+    return "\n".join(lines) + "\n"
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def metrics_table(entries, limit=20):
+    # Rows for the debug panel, slowest total wall time first
+    rows = []
+    for (kind, name), entry in sorted(entries.items(), key=lambda item: -item[1]["wall"])[:limit]:
+        count = max(entry["count"], 1)
+        rows.append({
+            "kind": kind,
+            "name": name,
+            "count": entry["count"],
+            "mean_ms": round(1000 * entry["wall"] / count, 1),
+            "cpu_ms": round(1000 * entry["cpu"] / count, 1),
+            "kb": round(entry["bytes"] / count / 1024, 1),
+            "peak_mb": round(entry["peak"] / 1024**2, 1),
+        })
+    return rows
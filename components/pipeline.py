@@ -0,0 +1,65 @@
+from components.data_acc import compute_spectrum, load_cached_pyramid, load_cached_quality, load_cached_spectrum, load_recording, save_cached_pyramid, save_cached_quality, save_cached_spectrum, set_default_montage
+from components.metrics import metrics, stage
+from components.quality import assess_quality
+from components.store import write_session_state
+
+# label shown in the UI while a stage runs, stage saved to the session state when it finishes
+upload_stages = [
+    ("Parsing file", "parsed"),
+    ("Setting montage", "montage"),
+    ("Checking signal quality", "quality"),
+    ("Computing power spectrum", "done"),
+]
+
+
+def process_upload(session_id, file_path, file_name, report=None):
+    """
+    Run upload stages parse -> montage -> quality -> PSD for a file saved in data/
+    Parsing also builds the decimation pyramid, so the raw view never waits for it in a web worker
+    Every finished stage is written to the session state, so plot callbacks in any
+    worker can use partial results (raw view before PSD) while the rest is running
+    report(stage_index, label, result) is called before every stage and at the end
+    Returns dict with upload_id, n_channels and stage
+    """
+    def run_stage(i, result=None):
+        if report is not None:
+            report(i, upload_stages[i][0] if i < len(upload_stages) else "Done", result)
+
+    run_stage(0)
+    with stage("upload.parse"):
+        upload_id, recording, raw = load_recording(file_path, file_name)
+    # decimation pyramid of the raw view is built here once, workers only memory-map it
+    with stage("upload.pyramid"):
+        if load_cached_pyramid(upload_id, raw.info['sfreq'], recording.shape[1]) is None:
+            save_cached_pyramid(upload_id, recording, raw.info['sfreq'])
+    result = {"upload_id": upload_id, "n_channels": len(raw.info['ch_names']), "stage": upload_stages[0][1]}
+    write_session_state(session_id, upload_id=upload_id, ch_names=raw.info['ch_names'], stage=result["stage"])
+
+    run_stage(1, result)
+    with stage("upload.montage"):
+        set_default_montage(raw)
+    result = dict(result, stage=upload_stages[1][1])
+    write_session_state(session_id, stage=result["stage"])
+
+    run_stage(2, result)
+    # bad channels and windows are found in one pass over the data, bad windows are left out of the PSD
+    with stage("upload.quality"):
+        quality = load_cached_quality(upload_id)
+        if quality is None:
+            quality = assess_quality(recording, raw.info['sfreq'])
+            save_cached_quality(upload_id, quality)
+        raw.info['bads'] = [raw.ch_names[i] for i in quality["bad_channels"]]
+    result = dict(result, stage=upload_stages[2][1])
+    write_session_state(session_id, stage=result["stage"])
+
+    run_stage(3, result)
+    # PSD is cached by content like the recording itself, it's computed block by block from the memory-mapped data
+    with stage("upload.psd"):
+        if load_cached_spectrum(upload_id, raw.info) is None:
+            save_cached_spectrum(upload_id, compute_spectrum(recording, raw.info, quality=quality))
+    result = dict(result, stage=upload_stages[3][1])
+    write_session_state(session_id, stage=result["stage"])
+
+    run_stage(len(upload_stages), result)
+    metrics.merge() # background job process ends with the job
+    return result
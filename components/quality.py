@@ -0,0 +1,93 @@
+import numpy as np
+
+from components.metrics import instrument
+
+window_seconds = 1.0 # length of windows the statistics are computed on
+z_threshold = 5.0 # robust z-score above which a channel or window is bad
+flat_ratio = 1e-3 # channel is flat if its typical std is below this fraction of the median channel
+line_ratio_threshold = 0.1 # line noise channel has at least this share of power at the line frequency
+line_freqs = (50.0, 60.0)
+
+
+def robust_z(values, axis=None, floor=0.1):
+    # (x - median) / (1.4826 MAD), MAD is floored so near-identical values don't give huge scores
+    median = np.median(values, axis=axis, keepdims=True)
+    mad = np.median(np.abs(values - median), axis=axis, keepdims=True)
+    return (values - median) / np.maximum(1.4826 * mad, floor)
+
+def window_statistics(data, sfreq, block_seconds=60):
+    """
+    Variance, peak-to-peak and line noise ratio of every channel in every window (n_channels, n_windows)
+    Windows of a block are transformed at once, so memory doesn't grow with recording length
+    Line noise ratio is power within 1 Hz of 50 or 60 Hz divided by power from 1 Hz up
+    """
+    n_window = max(2, int(round(window_seconds * sfreq)))
+    n_windows = data.shape[1] // n_window
+    freqs = np.fft.rfftfreq(n_window, 1 / sfreq)
+    line = np.zeros(len(freqs), dtype=bool)
+    for line_freq in line_freqs:
+        line |= np.abs(freqs - line_freq) <= 1
+    broadband = freqs >= 1
+    variance = np.empty((data.shape[0], n_windows), dtype=np.float32)
+    ptp = np.empty_like(variance)
+    line_ratio = np.empty_like(variance)
+    block = max(1, int(block_seconds / window_seconds))
+    for first in range(0, n_windows, block):
+        last = min(first + block, n_windows)
+        windows = np.asarray(data[:, first * n_window:last * n_window], dtype=np.float32).reshape(data.shape[0], -1, n_window)
+        variance[:, first:last] = windows.var(axis=2)
+        ptp[:, first:last] = windows.max(axis=2) - windows.min(axis=2)
+        power = np.abs(np.fft.rfft(windows - windows.mean(axis=2, keepdims=True), axis=2)) ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            line_ratio[:, first:last] = np.nan_to_num(power[:, :, line].sum(axis=2) / power[:, :, broadband].sum(axis=2))
+    return variance, ptp, line_ratio
+
+@instrument()
+def assess_quality(data, sfreq):
+    """
+    Mark bad channels and bad windows of data (n_channels, n_times) from window statistics
+    Channel is bad if it's flat, its typical variance is an outlier among channels (robust z on log scale)
+    or line noise takes a large outlying share of its power
+    Window is bad if peak-to-peak of any good channel is an outlier over time (blinks, movement)
+    Returns dict with bad_channels (indices), bad_windows (bool per window) and window_seconds
+    """
+    variance, ptp, line_ratio = window_statistics(data, sfreq)
+    n_channels, n_windows = variance.shape
+    if n_windows == 0:
+        return {"bad_channels": np.zeros(0, dtype=int), "bad_windows": np.zeros(0, dtype=bool), "window_seconds": window_seconds}
+    std = np.sqrt(np.median(variance, axis=1))
+    flat = std <= flat_ratio * np.median(std)
+    noisy = np.zeros(n_channels, dtype=bool)
+    if np.any(~flat):
+        noisy[~flat] = robust_z(np.log(std[~flat])) > z_threshold
+    line_share = np.median(line_ratio, axis=1)
+    line_noise = (robust_z(line_share, floor=0.01) > z_threshold) & (line_share > line_ratio_threshold)
+    bad = flat | noisy | line_noise
+
+    good = ~bad
+    if np.any(good):
+        log_ptp = np.log(np.maximum(ptp[good], np.finfo(np.float32).tiny))
+        bad_windows = np.any(robust_z(log_ptp, axis=1) > z_threshold, axis=0)
+    else:
+        bad_windows = np.zeros(n_windows, dtype=bool)
+    return {"bad_channels": np.flatnonzero(bad), "bad_windows": bad_windows, "window_seconds": window_seconds}
+
+def bad_intervals(quality):
+    # (start, stop) in seconds of runs of consecutive bad windows
+    padded = np.concatenate([[False], quality["bad_windows"], [False]])
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    return [(float(start * quality["window_seconds"]), float(stop * quality["window_seconds"])) for start, stop in zip(edges[0::2], edges[1::2])]
+
+def good_segments(quality, sfreq, n_fft, n_segments):
+    # Mask of consecutive segments of n_fft samples (Welch segments) that don't overlap any bad window
+    if quality is None or not np.any(quality["bad_windows"]):
+        return np.ones(n_segments, dtype=bool)
+    n_window = max(2, int(round(quality["window_seconds"] * sfreq)))
+    bad = np.flatnonzero(quality["bad_windows"])
+    first = bad * n_window // n_fft
+    last = np.minimum(((bad + 1) * n_window - 1) // n_fft + 1, n_segments)
+    inside = first < n_segments
+    coverage = np.zeros(n_segments + 1, dtype=np.int64)
+    np.add.at(coverage, first[inside], 1)
+    np.add.at(coverage, last[inside], -1)
+    return np.cumsum(coverage)[:-1] == 0
@@ -0,0 +1,64 @@
+import mne
+import numpy as np
+
+
+class Recording:
+    """
+    Channel matrix of an uploaded file built directly by the readers
+    data is C-contiguous float32 (n_channels, n_times), it may be memory-mapped
+    mne objects are made by to_mne() only where an mne algorithm needs them
+    """
+    __slots__ = ("data", "sfreq", "ch_names", "ch_types")
+
+    def __init__(self, data, sfreq, ch_names, ch_types=None):
+        if not isinstance(data, np.memmap):
+            data = np.ascontiguousarray(data, dtype=np.float32)
+        if data.ndim != 2 or data.shape[0] != len(ch_names):
+            raise ValueError(f"Expected data of shape ({len(ch_names)}, n_times), got {data.shape}")
+        self.data = data
+        self.sfreq = float(sfreq)
+        self.ch_names = list(ch_names)
+        self.ch_types = list(ch_types) if ch_types is not None else ["eeg"] * len(ch_names)
+
+    @property
+    def n_times(self):
+        return self.data.shape[1]
+
+    def info(self):
+        return mne.create_info(self.ch_names, self.sfreq, ch_types=self.ch_types)
+
+    def to_mne(self, preload=False):
+        # Unloaded Raw reading from data, preload=True makes float64 RawArray for in-place algorithms (filter)
+        if preload:
+            return mne.io.RawArray(self.data, self.info(), verbose=False)
+        return RawCached(self.data, self.info())
+
+    @classmethod
+    def from_mne(cls, raw, out=None, block_seconds=60):
+        """
+        Copy mne Raw block by block into float32 matrix, raw doesn't have to be preloaded
+        out can be preallocated (e.g. memory-mapped) array of shape (n_channels, n_times)
+        """
+        if out is None:
+            out = np.empty((len(raw.ch_names), raw.n_times), dtype=np.float32)
+        block = max(1, int(block_seconds * raw.info['sfreq']))
+        for start in range(0, raw.n_times, block):
+            stop = min(start + block, raw.n_times)
+            out[:, start:stop] = raw.get_data(start=start, stop=stop)
+        return cls(out, raw.info['sfreq'], raw.ch_names, raw.get_channel_types())
+
+
+class RawCached(mne.io.BaseRaw):
+    """
+    Unloaded mne Raw reading from (memory-mapped) array (n_channels, n_times)
+    raw[picks, start:stop] and get_data only read the requested channels and time span
+    """
+    def __init__(self, data, info):
+        super().__init__(info, preload=False, last_samps=[data.shape[1] - 1], raw_extras=[{"data": data}], orig_format="single")
+
+    def _read_segment_file(self, data, idx, fi, start, stop, cals, mult):
+        block = np.asarray(self._raw_extras[fi]["data"][idx, start:stop], dtype=data.dtype)
+        if mult is not None:
+            data[:] = mult @ block
+        else:
+            data[:] = block * cals
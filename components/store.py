@@ -0,0 +1,130 @@
+from collections import OrderedDict
+import json
+import os
+import threading
+import uuid
+
+from components.data_acc import compute_band_powers, data_folder, load_cached_pyramid, load_cached_quality, load_cached_recording, load_cached_spectrum, recording2mne, set_default_montage
+from components.helpers import is_valid_id, track_file
+
+
+class RecordingStore:
+    """
+    Uploaded recordings and their derived data resolved by session id
+    Upload stages are written to data/session_<id>.json by components/pipeline.py,
+    every worker rebuilds the session from it and the recording cache.
+    Sessions are kept in memory with LRU eviction and are refreshed until the
+    last stage is done, so partial results (raw view before PSD) can be used early
+    """
+    def __init__(self, max_sessions=8):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, session_id):
+        # Returns session dict or None if nothing was uploaded in this session
+        if not session_id:
+            return None
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+        state = read_session_state(session_id)
+        if state is None or is_current(session, state):
+            return session
+        session = restore_session(state, session)
+        if session is not None:
+            self._put(session_id, session)
+        return session
+
+    def rename_channels(self, session_id, mapping):
+        session = self.get(session_id)
+        if session is None:
+            return None
+        session["raw"].rename_channels(mapping)
+        write_session_state(session_id, ch_names=session["raw"].info['ch_names'])
+        return session
+
+    def _put(self, session_id, session):
+        with self._lock:
+            self._sessions[session_id] = session
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+def is_current(session, state):
+    # Check if session in memory matches state written by the pipeline or other workers
+    return (session is not None
+            and session["upload_id"] == state["upload_id"]
+            and session["stage"] == state["stage"]
+            and session["raw"].info['ch_names'] == state["ch_names"])
+
+def restore_session(state, session=None):
+    """
+    Build session for the given state, session of the same upload is updated in place
+    Returns None if the recording isn't in the cache
+    """
+    if session is None or session["upload_id"] != state["upload_id"]:
+        cached = load_cached_recording(state["upload_id"])
+        if cached is None:
+            return None
+        recording = cached[0]
+        raw = set_default_montage(recording2mne(*cached))
+        session = {
+            "upload_id": state["upload_id"],
+            "recording": recording,
+            "raw": raw,
+            "psd_info": raw.info.copy(), # spectrum keeps names from upload
+            "pyramid": None, # built by the upload pipeline, memory-mapped from the cache
+            "spectrum": None,
+            "band_powers": None,
+            "power_bands": None,
+            "segment_powers": None, # band power over time, computed on first use
+            "quality": None, # bad channels and windows, see components/quality.py
+            "connectivity": None, # coherence and PLV of channel pairs, computed on first use
+        }
+    if session["pyramid"] is None:
+        session["pyramid"] = load_cached_pyramid(state["upload_id"], session["raw"].info['sfreq'], session["recording"].shape[1])
+    if session["quality"] is None:
+        quality = load_cached_quality(state["upload_id"])
+        if quality is not None:
+            session["quality"] = quality
+            for info in (session["raw"].info, session["psd_info"]):
+                info['bads'] = [info['ch_names'][i] for i in quality["bad_channels"]]
+    if session["spectrum"] is None:
+        spectrum = load_cached_spectrum(state["upload_id"], session["psd_info"])
+        if spectrum is not None:
+            band_powers = compute_band_powers(spectrum)
+            session.update(spectrum=spectrum, band_powers=band_powers, power_bands=band_powers["bands"])
+    # apply channel assignments made after upload
+    if session["raw"].info['ch_names'] != state["ch_names"]:
+        session["raw"].rename_channels(dict(zip(session["raw"].info['ch_names'], state["ch_names"])))
+    session["stage"] = state["stage"]
+    return session
+
+def session_path(session_id):
+    if not is_valid_id(session_id):
+        raise ValueError(f"Invalid session id: {session_id}")
+    return os.path.join(data_folder, f"session_{session_id}.json")
+
+def read_session_state(session_id):
+    # Returns dict with upload_id, ch_names and stage or None if nothing was uploaded
+    try:
+        with open(session_path(session_id), "r") as f:
+            return json.load(f)
+    except (ValueError, FileNotFoundError):
+        return None
+
+def write_session_state(session_id, **fields):
+    # Merge fields into data/session_<id>.json
+    file_path = session_path(session_id)
+    state = read_session_state(session_id)
+    if state is None:
+        state = {}
+        track_file(os.path.basename(file_path))
+    state.update(fields)
+    tmp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, file_path)
@@ -0,0 +1,128 @@
+from functools import lru_cache
+
+import numpy as np
+from numpy.polynomial import legendre
+import plotly.graph_objects as go
+from plotly.subplots import make_subplots
+
+grid_size = 96 # topomap is interpolated on grid_size x grid_size points
+min_electrodes = 4 # fewer positioned channels can't define the head sphere
+
+
+def electrode_positions(info):
+    """
+    Returns names and unit vectors of channels with known position and their indices in info
+    Positions are taken from montage set by set_mont (channel loc), centred on fitted head sphere
+    """
+    names, positions, indices = [], [], []
+    for i, ch in enumerate(info['chs']):
+        pos = ch['loc'][:3]
+        if np.all(np.isfinite(pos)) and np.linalg.norm(pos) > 0:
+            names.append(ch['ch_name'])
+            positions.append(pos)
+            indices.append(i)
+    if len(positions) < min_electrodes:
+        return names, np.empty((0, 3)), indices
+    positions = np.array(positions) - fit_sphere_center(np.array(positions))
+    return names, positions / np.linalg.norm(positions, axis=1, keepdims=True), indices
+
+def fit_sphere_center(positions):
+    # Least squares sphere through electrodes, |p|^2 = 2 p.c + (r^2 - |c|^2)
+    system = np.hstack([2 * positions, np.ones((len(positions), 1))])
+    solution, *_ = np.linalg.lstsq(system, np.sum(positions ** 2, axis=1), rcond=None)
+    return solution[:3]
+
+def project(positions):
+    # Azimuthal equidistant projection from vertex, equator lies on unit circle
+    theta = np.arccos(np.clip(positions[:, 2], -1, 1))
+    phi = np.arctan2(positions[:, 1], positions[:, 0])
+    radius = theta / (np.pi / 2)
+    return radius * np.cos(phi), radius * np.sin(phi)
+
+def legendre_g(cosang, stiffness=4, n_terms=50):
+    # Spherical spline function g(x) from Perrin et al. (1989)
+    n = np.arange(1, n_terms + 1)
+    factors = np.concatenate([[0], (2 * n + 1) / (n * (n + 1)) ** stiffness / (4 * np.pi)])
+    return legendre.legval(cosang, factors)
+
+@lru_cache(maxsize=16)
+def interpolation_matrix(positions_key):
+    """
+    Precompute spherical spline interpolation from electrodes to the grid for one montage
+    positions_key is tuple of electrode unit vectors (hashable for the cache)
+    Returns matrix (n_grid_points, n_electrodes), grid coordinates and mask of points inside the head
+    """
+    positions = np.array(positions_key)
+    x, y = project(positions)
+    extent = max(1.0, np.max(np.hypot(x, y))) * 1.05
+    coords = np.linspace(-extent, extent, grid_size)
+    grid_x, grid_y = np.meshgrid(coords, coords)
+    inside = np.hypot(grid_x, grid_y) <= extent
+
+    # grid points back on the sphere
+    theta = np.hypot(grid_x[inside], grid_y[inside]) * np.pi / 2
+    phi = np.arctan2(grid_y[inside], grid_x[inside])
+    grid_positions = np.stack([np.sin(theta) * np.cos(phi), np.sin(theta) * np.sin(phi), np.cos(theta)], axis=1)
+
+    # spline weights with constant term: [G 1; 1 0] [c; c0] = [values; 0]
+    n = len(positions)
+    system = np.ones((n + 1, n + 1))
+    system[:n, :n] = legendre_g(positions @ positions.T)
+    system[n, n] = 0
+    inverse = np.linalg.pinv(system)[:, :n]
+    to_grid = np.hstack([legendre_g(grid_positions @ positions.T), np.ones((len(grid_positions), 1))])
+    return to_grid @ inverse, coords, inside
+
+def topomap_grid(info, values):
+    """
+    Interpolate channel values (n_channels, n_maps) to topomap grids (n_maps, grid_size, grid_size)
+    Every map is a single matrix product with the cached interpolation matrix
+    """
+    names, positions, indices = electrode_positions(info)
+    matrix, coords, inside = interpolation_matrix(tuple(map(tuple, np.round(positions, 6))))
+    grids = np.full((values.shape[1], grid_size, grid_size), np.nan)
+    grids[:, inside] = (matrix @ values[indices]).T
+    x, y = project(positions)
+    return grids, coords, (names, x, y)
+
+def plot_topomaps(info, values, titles, colorbar_title="Power (dB)"):
+    """
+    Plotly figure with one heatmap per column of values (n_channels, n_maps)
+    All maps share colour scale, electrodes are drawn as markers
+    """
+    if len(electrode_positions(info)[1]) < min_electrodes:
+        return empty_topomap(f"Topomap needs at least {min_electrodes} channels with a 10-20 position")
+    grids, coords, (names, x, y) = topomap_grid(info, values)
+    fig = make_subplots(rows=1, cols=len(titles), subplot_titles=titles, horizontal_spacing=0.02)
+    zmin, zmax = np.nanmin(grids), np.nanmax(grids)
+    outline = np.linspace(0, 2 * np.pi, 101)
+    extent = coords[-1]
+    for i in range(len(titles)):
+        fig.add_trace(go.Heatmap(
+            z=grids[i], x=coords, y=coords, zmin=zmin, zmax=zmax, colorscale="RdBu_r",
+            showscale=i == 0, colorbar=dict(title=colorbar_title), hoverinfo="skip",
+        ), row=1, col=i + 1)
+        fig.add_trace(go.Scatter(
+            x=x, y=y, mode="markers", text=names, hovertemplate="%{text}<extra></extra>",
+            marker=dict(color="black", size=4), showlegend=False,
+        ), row=1, col=i + 1)
+        # head outline and nose
+        fig.add_trace(go.Scatter(
+            x=np.concatenate([extent * np.cos(outline), [np.nan, -0.1 * extent, 0, 0.1 * extent]]),
+            y=np.concatenate([extent * np.sin(outline), [np.nan, extent, 1.1 * extent, extent]]),
+            mode="lines", line=dict(color="black", width=1), hoverinfo="skip", showlegend=False,
+        ), row=1, col=i + 1)
+    fig.update_xaxes(visible=False)
+    for i in range(len(titles)):
+        fig.update_yaxes(visible=False, scaleanchor=f"x{i + 1 if i else ''}", row=1, col=i + 1)
+    fig.update_layout(plot_bgcolor="white")
+    return fig
+
+def empty_topomap(message):
+    # Blank figure with the reason shown instead of the maps
+    fig = go.Figure()
+    fig.add_annotation(text=message, x=0.5, y=0.5, xref="paper", yref="paper", showarrow=False)
+    fig.update_xaxes(visible=False)
+    fig.update_yaxes(visible=False)
+    fig.update_layout(plot_bgcolor="white")
+    return fig
@@ -0,0 +1,182 @@
+import struct
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+# XDF chunk tags
+file_header_tag, stream_header_tag, samples_tag, clock_offset_tag, boundary_tag, stream_footer_tag = 1, 2, 3, 4, 5, 6
+# numeric channel formats, string streams (markers) are never decoded
+channel_formats = {
+    "float32": "<f4",
+    "double64": "<f8",
+    "int8": "i1",
+    "int16": "<i2",
+    "int32": "<i4",
+    "int64": "<i8",
+}
+
+
+def read_varlen(f):
+    # XDF variable length integer: 1 byte with number of bytes (1, 4 or 8) and the value
+    n_bytes = f.read(1)
+    if not n_bytes:
+        raise EOFError
+    value = f.read(n_bytes[0])
+    if len(value) != n_bytes[0]:
+        raise EOFError
+    return int.from_bytes(value, "little")
+
+def parse_stream_header(xml):
+    # Stream info from XML of a StreamHeader chunk
+    info = ET.fromstring(xml)
+    n_channels = int(info.findtext("channel_count", "0"))
+    labels = [channel.findtext("label") for channel in info.findall("desc/channels/channel")]
+    if len(labels) != n_channels or not all(labels):
+        labels = [f"CH{i+1}" for i in range(n_channels)]
+    return {
+        "name": info.findtext("name", ""),
+        "type": info.findtext("type", ""),
+        "n_channels": n_channels,
+        "srate": float(info.findtext("nominal_srate", "0")),
+        "format": info.findtext("channel_format", ""),
+        "ch_names": labels,
+        "chunks": [], # (start, stop, n_samples) of sample data of every Samples chunk
+        "n_samples": 0,
+        "clock_offsets": [], # (collection time, offset)
+    }
+
+def scan_xdf(file_path):
+    """
+    First pass over an XDF file reading chunk headers only, sample data is skipped with seek
+    Returns dict of streams by stream id with header info, byte ranges and sample counts
+    of Samples chunks and clock offsets, a truncated last chunk is ignored
+    """
+    streams = {}
+    with open(file_path, "rb") as f:
+        if f.read(4) != b"XDF:":
+            raise ValueError("Not an XDF file")
+        f.seek(0, 2)
+        file_size = f.tell()
+        f.seek(4)
+        while f.tell() < file_size:
+            try:
+                length = read_varlen(f)
+            except EOFError:
+                break
+            end = f.tell() + length
+            if end > file_size:
+                break
+            tag = struct.unpack("<H", f.read(2))[0]
+            if tag in (stream_header_tag, samples_tag, clock_offset_tag, stream_footer_tag):
+                stream_id = struct.unpack("<I", f.read(4))[0]
+                if tag == stream_header_tag:
+                    streams[stream_id] = parse_stream_header(f.read(end - f.tell()))
+                elif stream_id in streams:
+                    stream = streams[stream_id]
+                    if tag == samples_tag:
+                        n_samples = read_varlen(f)
+                        stream["chunks"].append((f.tell(), end, n_samples))
+                        stream["n_samples"] += n_samples
+                    elif tag == clock_offset_tag:
+                        stream["clock_offsets"].append(struct.unpack("<dd", f.read(16)))
+            f.seek(end)
+    return streams
+
+def find_stream(streams, stream_type="eeg"):
+    # First stream of the given type (case insensitive)
+    for stream in streams.values():
+        if stream["type"].lower() == stream_type.lower():
+            return stream
+    raise RuntimeError(f"No {stream_type.upper()} stream found in the XDF file.")
+
+def decode_samples(buf, n_samples, dtype, n_channels):
+    """
+    Values (n_samples, n_channels) and timestamps (NaN where omitted) of a Samples chunk
+    Every sample is [timestamp bytes (0 or 8)][timestamp][values], chunks where all samples
+    have or all lack timestamps are decoded without a loop over samples
+    """
+    value_bytes = dtype.itemsize * n_channels
+    raw = np.frombuffer(buf, dtype=np.uint8)
+    for stamp_bytes in (8, 0):
+        stride = 1 + stamp_bytes + value_bytes
+        if len(buf) == n_samples * stride and buf[0:len(buf):stride] == bytes([stamp_bytes]) * n_samples:
+            rows = raw.reshape(n_samples, stride)
+            values = np.ascontiguousarray(rows[:, 1 + stamp_bytes:]).view(dtype)
+            if stamp_bytes:
+                stamps = np.ascontiguousarray(rows[:, 1:9]).view("<f8")[:, 0]
+            else:
+                stamps = np.full(n_samples, np.nan)
+            return values, stamps
+    # mixed chunk, only offsets are found sample by sample
+    starts = np.empty(n_samples, dtype=np.int64)
+    stamps = np.full(n_samples, np.nan)
+    pos = 0
+    for i in range(n_samples):
+        if buf[pos] == 8:
+            stamps[i] = struct.unpack_from("<d", buf, pos + 1)[0]
+            pos += 9
+        else:
+            pos += 1
+        starts[i] = pos
+        pos += value_bytes
+    values = raw[starts[:, None] + np.arange(value_bytes)].view(dtype)
+    return values, stamps
+
+def read_stream(file_path, stream, out=None, with_timestamps=False, clock_sync=False):
+    """
+    Second pass: decode Samples chunks of one stream from scan_xdf into out (n_channels, n_samples)
+    Only byte ranges of this stream are read, chunk by chunk
+    Returns out and timestamps (None unless with_timestamps or clock_sync), omitted timestamps are
+    deduced from the nominal rate, clock_sync adds the clock offsets fitted by a line
+    """
+    if stream["format"] not in channel_formats:
+        raise ValueError(f"Unsupported channel format: {stream['format']}")
+    dtype = np.dtype(channel_formats[stream["format"]])
+    if out is None:
+        out = np.empty((stream["n_channels"], stream["n_samples"]), dtype=np.float32)
+    with_timestamps = with_timestamps or clock_sync
+    timestamps = np.empty(stream["n_samples"]) if with_timestamps else None
+    pos = 0
+    with open(file_path, "rb") as f:
+        for start, stop, n_samples in stream["chunks"]:
+            f.seek(start)
+            values, stamps = decode_samples(f.read(stop - start), n_samples, dtype, stream["n_channels"])
+            out[:, pos:pos + n_samples] = values.T
+            if with_timestamps:
+                timestamps[pos:pos + n_samples] = stamps
+            pos += n_samples
+    if with_timestamps:
+        timestamps = fill_timestamps(timestamps, stream["srate"])
+        if clock_sync:
+            timestamps = timestamps + clock_offset(stream["clock_offsets"], timestamps)
+    return out, timestamps
+
+def fill_timestamps(timestamps, srate):
+    # Omitted timestamps follow the last given one at the nominal rate
+    missing = np.isnan(timestamps)
+    if not missing.any():
+        return timestamps
+    given = np.flatnonzero(~missing)
+    if len(given) == 0:
+        return np.arange(len(timestamps)) / srate if srate > 0 else np.zeros(len(timestamps))
+    indices = np.arange(len(timestamps))
+    last = np.maximum.accumulate(np.where(missing, 0, indices))
+    last[:given[0]] = given[0] # samples before the first timestamp count back from it
+    step = 1 / srate if srate > 0 else 0
+    return timestamps[last] + (indices - last) * step
+
+def clock_offset(clock_offsets, timestamps):
+    # Offset to the recording host clock at every timestamp, line fitted through the measured offsets
+    if not clock_offsets:
+        return np.zeros_like(timestamps)
+    times, offsets = np.array(clock_offsets).T
+    if len(times) < 2 or np.ptp(times) == 0:
+        return np.full_like(timestamps, offsets.mean())
+    slope, intercept = np.polyfit(times, offsets, 1)
+    return intercept + slope * timestamps
+
+def effective_srate(timestamps):
+    # Sampling rate measured by timestamps
+    if len(timestamps) < 2 or timestamps[-1] <= timestamps[0]:
+        raise ValueError("Sampling rate can't be estimated from timestamps")
+    return (len(timestamps) - 1) / (timestamps[-1] - timestamps[0])
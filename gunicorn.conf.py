@@ -0,0 +1,19 @@
+# Application is imported once in the master and forked into workers,
+# so libraries and static data (montage) are loaded only once
+preload_app = True
+
+
+def when_ready(server):
+    # libraries imported lazily by the app are loaded before workers are forked
+    from components.data_acc import warm_up
+    warm_up()
+
+def post_fork(server, worker):
+    # threads of the master aren't copied into workers
+    from components.helpers import start_data_thread
+    start_data_thread()
+
+def worker_exit(server, worker):
+    # numbers of a restarted worker stay in the metrics total
+    from components.metrics import metrics
+    metrics.merge()
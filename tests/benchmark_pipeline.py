@@ -0,0 +1,212 @@
+"""
+Benchmark of the upload -> PSD -> plot pipeline on synthetic EEG
+Every configuration runs in a fresh process, every stage reports its time and peak RSS
+Results are printed (or written with --output) as JSON, --baseline compares them with an earlier run
+
+    python tests/benchmark_pipeline.py --channels 19 21 68 --sfreq 256 --duration 600
+    python tests/benchmark_pipeline.py --duration 3600 --output bench.json
+    python tests/benchmark_pipeline.py --baseline bench.json --tolerance 1.5
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from time import perf_counter
+
+import numpy as np
+
+repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def synthetic_eeg(n_channels, sfreq, duration, seed=0):
+    # Noise with a 1/f-like slow drift and alpha rhythm in uV, float32 (n_channels, n_times)
+    rng = np.random.default_rng(seed)
+    n_times = int(sfreq * duration)
+    data = rng.standard_normal((n_channels, n_times), dtype=np.float32) * 10
+    data += np.cumsum(rng.standard_normal((n_channels, n_times), dtype=np.float32), axis=1) * 0.05
+    times = np.arange(n_times, dtype=np.float32) / sfreq
+    phases = rng.uniform(0, 2 * np.pi, (n_channels, 1)).astype(np.float32)
+    data += 20 * np.sin(2 * np.pi * 10 * times + phases)
+    return data
+
+def reset_peak_rss():
+    # Linux can reset the peak RSS of the process (VmHWM), elsewhere the peak is cumulative
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_config(n_channels, sfreq, duration, repeat):
+    """
+    Run all stages for one recording size, returns dict of stage -> seconds (best of repeat) and peak RSS
+    Stages reading tables are only run for 19 channels, the only layout the CSV/XLS readers accept
+    """
+    os.chdir(repo_folder)
+    sys.path.insert(0, repo_folder)
+    import pandas as pd
+    import plotly.graph_objects as go
+    from components.data_acc import (
+        build_pyramid, calculate_psd, channels_names_21, channels_names_68, check_columns,
+        compute_band_powers, compute_connectivity, compute_segment_powers, compute_spectrum, default_channel_names,
+        extract_all_power_bands, pd2mne, plot_band_topomaps, plot_raw_channels, power_band2csv, read_file,
+        set_default_montage, table2recording,
+    )
+    from components.helpers import create_file, filter_data, initialize
+    from components.quality import assess_quality
+    import mne
+    mne.set_log_level("WARNING")
+    initialize()
+
+    # channels_names_68 has fewer names than channels, the rest get generic ones
+    names = {19: default_channel_names, 21: channels_names_21, 68: channels_names_68}.get(n_channels, [])
+    names = list(names[:n_channels]) + [f"CH{i + 1}" for i in range(len(names), n_channels)]
+    data = synthetic_eeg(n_channels, sfreq, duration)
+    stages = {}
+    results = {}
+
+    def stage(name, func):
+        # best time and highest peak RSS of repeat runs, result of the last run is kept
+        best, peak = None, 0
+        for _ in range(repeat):
+            reset_peak_rss()
+            start = perf_counter()
+            result = func()
+            elapsed = perf_counter() - start
+            peak = max(peak, peak_rss_mb())
+            best = elapsed if best is None else min(best, elapsed)
+        stages[name] = {"seconds": round(best, 6), "peak_rss_mb": round(peak, 1)}
+        results[name] = result
+        return result
+
+    if n_channels == len(default_channel_names):
+        csv_text = pd.DataFrame(data.T, columns=names).to_csv(index=False)
+        contents = "data:text/csv;base64," + base64.b64encode(csv_text.encode("utf8")).decode("ascii")
+        del csv_text
+        paths = []
+        stage("create_file", lambda: paths.append(create_file(contents, "csv")) or paths[-1])
+        stage("read_file", lambda: read_file(paths[-1], "synthetic.csv"))
+        for path in paths:
+            os.remove(path)
+        del contents
+        table = pd.DataFrame(data.T)
+        stage("check_columns", lambda: check_columns(table))
+        stage("table2recording", lambda: table2recording(table))
+        stage("pd2mne", lambda: pd2mne(results["check_columns"]))
+        results.clear()
+        del table
+    # table readers assume 256 Hz, later stages use the synthetic data with the configured rate
+    raw = mne.io.RawArray(data, mne.create_info(names, sfreq, ch_types="eeg"), verbose=False)
+    set_default_montage(raw)
+
+    stage("assess_quality", lambda: assess_quality(data, sfreq))
+    spectrum = stage("calculate_psd", lambda: calculate_psd(raw)[0])
+    stage("compute_spectrum", lambda: compute_spectrum(data, raw.info))
+    power_bands = stage("extract_all_power_bands", lambda: extract_all_power_bands(spectrum))
+    band_powers = stage("compute_band_powers", lambda: compute_band_powers(spectrum))
+    stage("compute_segment_powers", lambda: compute_segment_powers(data, sfreq))
+    stage("compute_connectivity", lambda: compute_connectivity(data, sfreq))
+    stage("filter_data", lambda: filter_data(raw, 8, 13))
+    del results["filter_data"]
+
+    shown = list(raw.ch_names)
+    pyramid = stage("build_pyramid", lambda: build_pyramid(data, sfreq))
+    stage("plot_raw_channels", lambda: plot_raw_channels(raw, shown))
+    stage("plot_raw_channels_pyramid", lambda: plot_raw_channels(raw, shown, pyramid=pyramid))
+
+    def raw_figure():
+        times, values = results["plot_raw_channels_pyramid"]
+        fig = go.Figure([go.Scatter(x=times[i], y=values[i], mode="lines", name=ch) for i, ch in enumerate(shown)])
+        return fig.to_json()
+    stage("raw_figure_json", raw_figure)
+    topomaps = stage("plot_band_topomaps", lambda: plot_band_topomaps(spectrum, band_powers))
+    stage("topomap_figure_json", lambda: topomaps.to_json())
+    stage("power_band2csv", lambda: power_band2csv(power_bands, shown).to_csv())
+
+    return {
+        "config": {"channels": n_channels, "sfreq": sfreq, "duration": duration, "repeat": repeat},
+        "stages": stages,
+        "total_seconds": round(sum(s["seconds"] for s in stages.values()), 6),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def compare(results, baseline, tolerance):
+    # Returns list of stages slower or heavier than tolerance times the baseline
+    regressions = []
+    previous = {json.dumps(r["config"], sort_keys=True): r for r in baseline["results"]}
+    for result in results:
+        old = previous.get(json.dumps(result["config"], sort_keys=True))
+        if old is None:
+            continue
+        for name, now in result["stages"].items():
+            before = old["stages"].get(name)
+            if before is None:
+                continue
+            for metric in ("seconds", "peak_rss_mb"):
+                if now[metric] > tolerance * before[metric] and now[metric] - before[metric] > 0.01:
+                    regressions.append(f"{result['config']} {name} {metric}: {before[metric]} -> {now[metric]}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--channels", type=int, nargs="+", default=[19, 21, 68])
+    parser.add_argument("--sfreq", type=float, default=256)
+    parser.add_argument("--duration", type=float, nargs="+", default=[60], help="seconds of signal")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=1.5, help="allowed ratio to the baseline")
+    args = parser.parse_args()
+
+    import mne
+    import pandas as pd
+    report = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "mne": mne.__version__,
+            "cpus": os.cpu_count(),
+        },
+        "results": [],
+    }
+    for duration in args.duration:
+        for n_channels in args.channels:
+            # fresh process per configuration, so caches and peak memory don't leak between them
+            with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+                result = pool.submit(run_config, n_channels, args.sfreq, duration, args.repeat).result()
+            print(f"{n_channels} channels, {duration} s: {result['total_seconds']:.2f} s, peak {result['peak_rss_mb']} MB", file=sys.stderr)
+            report["results"].append(result)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report["results"], json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"Regression: {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Benchmark of worker start: time to import app and to serve the first page, in fresh processes
+Slowest imports are taken from python -X importtime, results are printed as JSON
+
+    python tests/benchmark_startup.py --repeat 5
+    python tests/benchmark_startup.py --output startup.json
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in a fresh interpreter, prints JSON with timings
+probe = """
+import json, resource
+from time import perf_counter
+start = perf_counter()
+import app
+imported = perf_counter()
+response = app.server.test_client().get("/")
+served = perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "first_page_seconds": served - imported,
+    "status": response.status_code,
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+"""
+
+
+def run_probe():
+    output = subprocess.run([sys.executable, "-c", probe], cwd=repo_folder, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def slowest_imports(limit=15):
+    # Modules with the highest cumulative import time (seconds) from python -X importtime
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=repo_folder, capture_output=True, text=True, check=True)
+    modules = []
+    for line in output.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative) / 1e6, name.strip()))
+    return [{"module": name, "seconds": seconds} for seconds, name in sorted(modules, reverse=True)[:limit]]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    runs = [run_probe() for _ in range(args.repeat)]
+    report = {"runs": runs, "slowest_imports": slowest_imports()}
+    for key in ("import_seconds", "first_page_seconds", "rss_mb"):
+        values = [run[key] for run in runs]
+        report[key] = {"min": min(values), "median": statistics.median(values), "max": max(values)}
+    print(f"import {report['import_seconds']['median']:.2f} s, first page {report['first_page_seconds']['median']:.3f} s", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
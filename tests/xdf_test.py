@@ -0,0 +1,149 @@
+import os
+import struct
+import sys
+
+import numpy as np
+import pytest
+
+# tests run from any folder, components are imported from the repository
+repo_folder = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_folder)
+
+import components.data_acc as data_acc
+import components.helpers as helpers
+from components.xdf import find_stream, read_stream, scan_xdf
+
+# Fixture: small XDF file written sample by sample like LabRecorder does
+eeg_channels = 4
+eeg_srate = 256.0
+eeg_samples = 1000
+eeg_chunk = 37
+t0 = 1000.0
+clock_offset = (0.5, 0.001) # offset at t0 and its drift per second
+
+
+def varlen(n):
+    return b"\x01" + bytes([n]) if n < 256 else b"\x04" + struct.pack("<I", n)
+
+def chunk(tag, content):
+    body = struct.pack("<H", tag) + content
+    return b"\x04" + struct.pack("<I", len(body)) + body
+
+def stream_header(stream_id, name, stream_type, n_channels, srate, channel_format):
+    channels = "".join(f"<channel><label>E{i}</label></channel>" for i in range(n_channels))
+    xml = (f"<?xml version='1.0'?><info><name>{name}</name><type>{stream_type}</type><channel_count>{n_channels}</channel_count>"
+           f"<nominal_srate>{srate}</nominal_srate><channel_format>{channel_format}</channel_format>"
+           f"<desc><channels>{channels}</channels></desc></info>")
+    return chunk(2, struct.pack("<I", stream_id) + xml.encode())
+
+def eeg_values():
+    return np.random.default_rng(0).standard_normal((eeg_samples, eeg_channels)).astype(np.float32)
+
+def write_xdf(path):
+    """
+    XDF file with a markers stream, an EEG stream (float32), an accelerometer stream (int16) and clock offsets
+    EEG chunks mix stamped and omitted timestamps: every 3rd chunk is fully stamped,
+    every 5th has none, the others only stamp their first sample
+    """
+    eeg = eeg_values()
+    parts = [
+        b"XDF:",
+        chunk(1, b"<?xml version='1.0'?><info><version>1.0</version></info>"),
+        stream_header(2, "markers", "Markers", 1, 0, "string"),
+        stream_header(1, "eeg", "EEG", eeg_channels, eeg_srate, "float32"),
+        stream_header(3, "acc", "Accelerometer", 3, 50, "int16"),
+    ]
+    pos, k = 0, 0
+    while pos < eeg_samples:
+        n = min(eeg_samples - pos, eeg_chunk)
+        body = b""
+        for i in range(n):
+            stamped = k % 3 == 0 or (i == 0 and k % 5 != 0)
+            stamp = b"\x08" + struct.pack("<d", t0 + (pos + i) / eeg_srate) if stamped else b"\x00"
+            body += stamp + eeg[pos + i].tobytes()
+        parts.append(chunk(3, struct.pack("<I", 1) + varlen(n) + body))
+        if k % 10 == 0:
+            parts.append(chunk(3, struct.pack("<I", 2) + varlen(1) + b"\x08" + struct.pack("<d", t0 + pos / eeg_srate) + varlen(3) + b"hey"))
+            parts.append(chunk(3, struct.pack("<I", 3) + varlen(2) + (b"\x00" + np.arange(3, dtype="<i2").tobytes()) * 2))
+            elapsed = pos / eeg_srate
+            parts.append(chunk(4, struct.pack("<Idd", 1, t0 + elapsed, clock_offset[0] + clock_offset[1] * elapsed)))
+        pos += n
+        k += 1
+    with open(path, "wb") as f:
+        f.write(b"".join(parts))
+    return path
+
+@pytest.fixture
+def xdf_file(tmp_path):
+    return str(write_xdf(tmp_path / "fixture.xdf"))
+
+
+def test_scan_finds_all_streams(xdf_file):
+    streams = scan_xdf(xdf_file)
+    assert sorted(stream["type"] for stream in streams.values()) == ["Accelerometer", "EEG", "Markers"]
+    eeg = find_stream(streams, "eeg")
+    assert eeg["n_samples"] == eeg_samples
+    assert eeg["ch_names"] == [f"E{i}" for i in range(eeg_channels)]
+    assert len(eeg["clock_offsets"]) == 3 # every 10th of 28 EEG chunks
+    with pytest.raises(RuntimeError):
+        find_stream(streams, "video")
+
+def test_eeg_samples_and_timestamps(xdf_file):
+    eeg = find_stream(scan_xdf(xdf_file), "eeg")
+    data, timestamps = read_stream(xdf_file, eeg, with_timestamps=True)
+    assert np.array_equal(data, eeg_values().T)
+    # omitted timestamps are deduced from the nominal rate
+    assert np.allclose(timestamps, t0 + np.arange(eeg_samples) / eeg_srate)
+
+def test_int16_stream(xdf_file):
+    acc = find_stream(scan_xdf(xdf_file), "accelerometer")
+    data, _ = read_stream(xdf_file, acc)
+    assert data.shape == (3, acc["n_samples"])
+    assert np.array_equal(data, np.tile(np.arange(3, dtype=np.float32)[:, None], acc["n_samples"]))
+
+def test_clock_sync(xdf_file):
+    eeg = find_stream(scan_xdf(xdf_file), "eeg")
+    _, timestamps = read_stream(xdf_file, eeg, clock_sync=True)
+    expected = t0 + np.arange(eeg_samples) / eeg_srate
+    assert np.allclose(timestamps, expected + clock_offset[0] + clock_offset[1] * (expected - t0))
+
+def test_truncated_file(xdf_file):
+    # a recording cut off in the middle of the last chunk keeps the complete chunks
+    size = os.path.getsize(xdf_file)
+    with open(xdf_file, "r+b") as f:
+        f.truncate(size - 10)
+    eeg = find_stream(scan_xdf(xdf_file), "eeg")
+    data, _ = read_stream(xdf_file, eeg)
+    assert 0 < eeg["n_samples"] < eeg_samples
+    assert np.array_equal(data, eeg_values().T[:, :eeg["n_samples"]])
+
+def test_read_raw_xdf(xdf_file, tmp_path, monkeypatch):
+    monkeypatch.setattr(data_acc, "data_folder", str(tmp_path))
+    monkeypatch.setattr(data_acc, "track_file", lambda file_name: None)
+    recording = data_acc.read_raw_xdf(xdf_file)
+    assert recording.sfreq == eeg_srate
+    assert recording.ch_names == [f"E{i}" for i in range(eeg_channels)]
+    assert np.array_equal(recording.data, eeg_values().T)
+    synced = data_acc.read_raw_xdf(xdf_file, clock_sync=True)
+    assert synced.sfreq == pytest.approx(eeg_srate / (1 + clock_offset[1]))
+
+def test_cached_xdf_counts_once(xdf_file, tmp_path, monkeypatch):
+    # reader output is renamed into the cache, its temporary name must not stay in the tracker
+    monkeypatch.setattr(data_acc, "data_folder", str(tmp_path))
+    monkeypatch.setattr(helpers, "temp_files", helpers.TempFileManager(folder=str(tmp_path), db_path=str(tmp_path / "temp_files.db")))
+    recording = data_acc.read_raw_xdf(xdf_file)
+    key = "0" * 32
+    data_acc.save_cached_recording(key, recording)
+    tracked = [name for name, in helpers.temp_files._db().execute("SELECT name FROM temp_files")]
+    assert sorted(tracked) == [f"{key}.json", f"{key}.npy"]
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".npy")) == [f"{key}.npy"]
+    assert np.array_equal(data_acc.load_cached_recording(key)[0], eeg_values().T)
+
+def test_matches_pyxdf(xdf_file):
+    pyxdf = pytest.importorskip("pyxdf") # reference reader, not a dependency of the app
+    streams, _ = pyxdf.load_xdf(xdf_file, synchronize_clocks=False, dejitter_timestamps=False)
+    reference = next(stream for stream in streams if stream["info"]["type"][0] == "EEG")
+    eeg = find_stream(scan_xdf(xdf_file), "eeg")
+    data, timestamps = read_stream(xdf_file, eeg, with_timestamps=True)
+    assert np.array_equal(data, reference["time_series"].T)
+    assert np.allclose(timestamps, reference["time_stamps"])